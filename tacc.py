@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import subprocess, shutil, time, sys, signal, math, os, datetime, threading
+import subprocess, shutil, time, sys, signal, math, os, datetime, threading, asyncio, socket, json, queue
 import numpy as np
 
 from PyQt5.QtWidgets import QApplication, QMessageBox
@@ -16,49 +16,422 @@ from icicle import hubercc508
 from influxdb_client import InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
 
-from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from dataclasses import dataclass, field
 
 import logging, click
 
+import tacc_sim
+
 processes = []
 instruments = {}
-please_kill = False
+please_kill = threading.Event()     # set by the first Ctrl+C: finish the current cycle, then stop
+please_abort = threading.Event()    # set when the running cycle must be abandoned straight away
 SHORT_DELAY = 0.3
 LONG_DELAY = 0.5 + SHORT_DELAY
+WATCHDOG_PERIOD = 1.0       # seconds between interlock watchdog checks
+WATCHDOG_DEADLINE = 2.0     # seconds a watchdog check may take before it counts as missed
+WATCHDOG_MAX_MISSES = 3     # consecutive missed checks before the watchdog trips
+WATCHDOG_WALL_FLOOR = 0.25  # wall clock seconds a check is given at least, however fast a simulated run clock
+TELEMETRY_PERIOD = 10.0     # seconds between telemetry records
+MINI_RAMP_MARGIN = 5.0      # chuck temp - dewpoint below which the mini ramp up fires
+FORECAST_WINDOW = 300.0     # seconds of history the dewpoint margin forecast is fitted on
+FORECAST_HORIZON = 180.0    # seconds ahead a forecast margin violation slows the descent
+FORECAST_SLOWDOWN = 0.25    # fraction of the ramp rate used while a margin violation is forecast
+CONTROL_PERIOD = 2.0        # seconds between control ticks of the ramps
+RAMP_DOWN_RATE = 2.0        # maximum rate of the PID setpoints in ramp down, °C/min
+TRACKING_ERROR = 3.0        # °C the NTCs may lag the setpoint before it stops advancing
+RAMP_TOLERANCE = 1.0        # °C from the target at which a ramp is complete
+PRECOOL_MARGIN = 5.0        # °C above the chiller setpoint at which the chucks count as pre-cooled
+PRECOOL_FLAT_RATE = 0.1     # °C/min below which the chuck temperature counts as flattened out
+PRECOOL_WINDOW = 120.0      # seconds the chuck rate of change is measured over during pre-cool
+TICK_REPORT_INTERVAL = 60.0 # seconds between overrun warnings of one periodic loop
+# Minimum gap in seconds between consecutive commands to the same resource, per instrument
+COMMAND_GAPS = {
+    'interlock': 0.0,
+    'lv_psu': SHORT_DELAY,
+    'pelt_psu': SHORT_DELAY,
+    'hv_psu': SHORT_DELAY,
+    'huber': SHORT_DELAY,
+    'pid': LONG_DELAY,
+}
 
 class Instruments:
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
+class WallClock:
+    """Run clock of a real test box: the clocks of the time module. The run clock of a test box
+    is passed around as instruments.clock; tacc_sim.SimClock has the same interface and runs
+    speed times faster, so every period and timeout of the run is in run clock seconds.
+    """
+    speed = 1.0     # run clock seconds per wall clock second
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def perf_counter(self) -> float:
+        return time.perf_counter()
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0))
+
+    def wait(self, event, seconds) -> bool:
+        """Waits up to seconds of run clock time for event.
+        Returns:
+            True if the event is set.
+        """
+        return event.wait(max(seconds, 0) / self.speed)
+
+WALL_CLOCK = WallClock()
+
+def clock_of(instruments):
+    """The run clock of the instruments, the wall clock if they have none."""
+    return getattr(instruments, 'clock', None) or WALL_CLOCK
+
+class Ticker:
+    """Fixed-rate schedule of a periodic loop. wait() ends the current tick and sleeps until the
+    next one, on a grid of period from the start, so the rate does not drift with the time the
+    work takes. A tick whose work overruns the period is counted and reported, and the ticks it
+    ran into are skipped rather than run back to back, so the bus load stays bounded.
+    """
+    def __init__(self, name, period, event = None, clock = WALL_CLOCK):
+        self.name = name
+        self.clock = clock
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.busy = 0.0
+        self.worst = 0.0
+        self._reported = -math.inf
+        self._unreported = 0
+        self.event = please_abort
+        self.restart(period, event)
+
+    def restart(self, period = None, event = None):
+        """Starts a new schedule from now, optionally with a new period or event. Statistics carry over."""
+        if period is not None:
+            self.period = period
+        if event is not None:
+            self.event = event
+        self._tick_start = self._slot = self.clock.monotonic()
+        self._next = self._slot + self.period
+
+    def wait(self) -> bool:
+        """Ends the current tick and waits for the next one.
+        Returns:
+            True if the event was set, i.e. the loop should stop.
+        """
+        now = self.clock.monotonic()
+        work = now - self._tick_start
+        self.ticks += 1
+        self.busy += work
+        self.worst = max(self.worst, work)
+        if now > self._next:
+            missed = math.ceil((now - self._next) / self.period)
+            self.overruns += 1
+            self.skipped += missed
+            self._next += missed * self.period
+            self._report(now - self._slot, work, missed, now)
+        stopped = self.clock.wait(self.event, self._next - now)
+        self._tick_start = self.clock.monotonic()
+        self._slot = self._next
+        self._next += self.period
+        return stopped
+
+    def _report(self, late, work, missed, now):
+        # at most one warning per TICK_REPORT_INTERVAL, counting the overruns in between
+        self._unreported += 1
+        if now - self._reported >= TICK_REPORT_INTERVAL:
+            logging.warning(f"{self.name} tick overran its {self.period:g}s period: done {late:.2f}s after its scheduled start "
+                            f"({work:.2f}s of work), skipped {missed} tick(s)"
+                            + (f" ({self._unreported} overruns since the last report)" if self._unreported > 1 else ''))
+            self._reported, self._unreported = now, 0
+
+    def summary(self) -> str:
+        mean = self.busy / max(self.ticks, 1)
+        return (f"{self.ticks} ticks of {self.period:g}s, work mean {1000 * mean:.0f}ms max {1000 * self.worst:.0f}ms, "
+                f"{self.overruns} overruns, {self.skipped} ticks skipped")
+
+tickers = {}
+
+def ticker(name, period, event = None, clock = WALL_CLOCK) -> Ticker:
+    """The Ticker of the named loop on a fresh schedule of the clock. Its statistics accumulate over the run."""
+    if name in tickers:
+        tickers[name].clock = clock
+        tickers[name].restart(period, event)
+    else:
+        tickers[name] = Ticker(name, period, event, clock)
+    return tickers[name]
+
+class Bus:
+    """Worker thread owning one physical instrument link (TCP socket or serial port).
+    Everything submitted to a bus runs on its single worker, in order, so reads on
+    different buses overlap while accesses to the same link never do. With a limiter,
+    every job runs inside it, so the jobs also keep the command gap of the resource and
+    exclude the commands sent outside the bus under throttle().
+    """
+    def __init__(self, name, limiter = None):
+        self.name = name
+        self.limiter = limiter
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bus-{name}")
+
+    def submit(self, fn, *args, **kwargs):
+        if self.limiter is not None:
+            return self._executor.submit(self._limited, fn, *args, **kwargs)
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def _limited(self, fn, *args, **kwargs):
+        with self.limiter:
+            return fn(*args, **kwargs)
+
+    def call(self, fn, *args, **kwargs):
+        return self.submit(fn, *args, **kwargs).result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+BUS_NAMES = ['interlock', 'lv_psu', 'pelt_psu', 'hv_psu', 'huber']
+
+def make_buses(limiters = None) -> dict:
+    """One Bus per name of BUS_NAMES, each running its jobs in limiters[name] if given."""
+    limiters = limiters or {}
+    return {name: Bus(name, limiters.get(name)) for name in BUS_NAMES}
+
+def on_bus(instruments, name, fn, *args, **kwargs):
+    """Submits fn to the named bus worker, or runs it inline if the instruments have no buses.
+    Returns a future-like object with a result() method.
+    """
+    buses = getattr(instruments, 'buses', None)
+    if buses and name in buses:
+        return buses[name].submit(fn, *args, **kwargs)
+    return _Done(fn(*args, **kwargs))
+
+class _Done:
+    def __init__(self, value):
+        self.value = value
+
+    def result(self, timeout = None):
+        return self.value
+
 ENDPOINT = 'http://pplxatlasitk02.nat.physics.ox.ac.uk:8086'
+# Instrument resources of the test box; the PID controllers listen on pid_port0 + module number,
+# each configured by pid_config with {module} filled in
+RESOURCES = {
+    'interlock': 'TCPIP::localhost::9898::SOCKET',
+    'lv_psu': 'ASRL/dev/ttyHMP4040a::INSTR',
+    'pelt_psu': 'ASRL/dev/ttyHMP4040b::INSTR',
+    'hv_psu': 'ASRL/dev/ttyUSB0::INSTR',
+    #'hv_psu': 'ASRL/dev/ttyHMP4040b::INSTR', #PLACEHOLDER FOR WHEN THE HV ISN'T ATTACHED, REMOVE!!!!
+    'huber': '/dev/ttyACM0',
+    'pid_port0': 19895,
+    'pid_config': './pidcontroller_j{module}.toml',
+}
+BOX_NAME = ''               # name of the test box when run by tacc_supervisor.py, tagged on the database points
+
+class RateLimiter:
+    """Enforces a minimum gap between consecutive commands to one resource (serial port or socket).
+    Used as a context manager around a command: it only waits if the resource was touched less
+    than gap seconds ago, and holds the resource for the duration of the command. It is the one
+    serialisation point of its resource: the Bus of the resource runs every job inside it, and
+    commands sent outside the bus take it with throttle(). The lock is reentrant, so a bus job
+    may throttle() its own channels.
+    """
+    def __init__(self, gap, clock = WALL_CLOCK):
+        self.gap = gap
+        self.clock = clock
+        self._last = -math.inf
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        wait = self._last + self.gap - self.clock.monotonic()
+        if wait > 0:
+            self.clock.sleep(wait)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._last = self.clock.monotonic()
+        self._lock.release()
+
+_limiters = {}
+
+def register_limiter(channels : list, instrument : str, clock = WALL_CLOCK) -> RateLimiter:
+    """Makes all the channels in the list share one RateLimiter, with the gap configured for the instrument."""
+    limiter = RateLimiter(COMMAND_GAPS[instrument], clock)
+    for ch in channels:
+        _limiters[id(ch)] = limiter
+    return limiter
+
+def throttle(channel) -> RateLimiter:
+    """Returns the RateLimiter of the resource the channel belongs to.
+    Channels that were never registered get their own limiter with the conservative LONG_DELAY gap.
+    """
+    limiter = _limiters.get(id(channel))
+    if limiter is None:
+        limiter = _limiters.setdefault(id(channel), RateLimiter(LONG_DELAY))
+    return limiter
+
+@dataclass
+class PIDResult:
+    """Outcome of a group command on one PID controller."""
+    index: int
+    ok: bool
+    value: object = None
+    error: Exception = None
+
+def reconnect(channel) -> bool:
+    """Closes and reopens the session of a channel, e.g. after its socket dropped."""
+    logging.warning(f"Reconnecting {channel!r}")
+    try:
+        channel.__exit__(None, None, None)
+    except Exception as e:
+        logging.debug(f"Error closing {channel!r}: {e}")
+    try:
+        with throttle(channel):
+            channel.__enter__()
+        return True
+    except Exception as e:
+        logging.error(f"Error reconnecting {channel!r}: {e}")
+        return False
+
+def pid_group_command(pelts : list, command, attempts = 2) -> list:
+    """Sends a command to all the PID controllers concurrently, one thread per controller.
+    Each controller listens on its own port, so the commands do not contend with each other
+    and the whole group costs a single round trip.
+    Args:
+        pelts: list of peltier (PID controller) channels
+        command: callable taking a channel and returning the value to report
+        attempts: number of tries per controller before reporting the error, reconnecting in between
+    Returns:
+        A list of PIDResult, in the order of pelts.
+    """
+    def run(i, pelt):
+        for attempt in range(attempts):
+            try:
+                with throttle(pelt):
+                    return PIDResult(i, True, command(pelt))
+            except Exception as e:
+                logging.error(f"Error commanding pelt{i}: {e}")
+                error = e
+                if attempt < attempts - 1:
+                    reconnect(pelt)
+        return PIDResult(i, False, error=error)
+
+    if not pelts:
+        return []
+    with ThreadPoolExecutor(max_workers=len(pelts), thread_name_prefix='pid') as executor:
+        futures = [executor.submit(run, i, pelt) for i, pelt in enumerate(pelts)]
+        return [f.result() for f in futures]
 
 def pelts_read(pelts) -> list:
-    peltier_on = []
-    for i, pelt in enumerate(pelts):
-        time.sleep(LONG_DELAY)
-        logging.debug(f"Reading state of pelt{i}")
-        peltier_on.append(pelt.state)
-    return peltier_on
-
-def pelts_on_off(pelts : list, switch : bool):
+    logging.debug("Reading state of pelts")
+    return [r.value for r in pid_group_command(pelts, lambda pelt: pelt.state)]
+
+def pelts_set_temperature(pelts : list, temp : float) -> list:
+    """Sets the temperature setpoint of all the PID controllers at once."""
+    def set_temperature(pelt):
+        pelt.temperature = temp
+    return pid_group_command(pelts, set_temperature)
+
+def pelts_on_off(pelts : list, switch : bool, event = None, pelt_psu = None) -> list:
     """ Turns the peltiers in the pelt list on or off, according to the value of switch.
+    All the PID controllers are commanded concurrently.
     Args:
         - pelt: list of peltier objects
         - switch: True for turning on, False for turning off 
+        - event: InterlockEvent to timestamp the commands on
+        - pelt_psu: peltier supply channels, in the order of pelts. When switching off with an
+          event, their outputs are read back to confirm the peltiers off (see confirm_pelts_off).
+    Returns:
+        A list of PIDResult, one per peltier.
+    """
+    clock = event.clock if event is not None else WALL_CLOCK
+    def set_state(pelt):
+        pelt.state = bool(switch)
+        return clock.time()
+    logging.debug(f"Setting pelts state to {switch}")
+    results = pid_group_command(pelts, set_state, attempts=3)
+    for r in results:
+        if not r.ok:
+            logging.critical(f"Failed to set pelt{r.index} state to {switch}: {r.error}")
+        elif event is not None:
+            event.sent[r.index] = r.value
+    if event is not None and not switch and pelt_psu:
+        confirm_pelts_off(pelt_psu, event)
+    return results
+
+PELT_OFF_CURRENT = 0.05     # A of peltier supply output below which a peltier counts as off
+PELT_CONFIRM_TIMEOUT = 2.0  # seconds the peltier supply outputs are read back for before giving up
+
+def confirm_pelts_off(pelt_psu : list, event, timeout = PELT_CONFIRM_TIMEOUT):
+    """Reads the output current of the peltier supply channels of the peltiers commanded off in
+    event.sent until each is below PELT_OFF_CURRENT, and records the time of the readback that
+    showed it off in event.confirmed. The PID controllers only echo back their own state, so the
+    supply output is what shows that the current has actually stopped.
     """
-    for i, pelt in enumerate(pelts):
-        time.sleep(LONG_DELAY)
-        for i in range(3):
-            logging.debug(f"Setting pelt{i} state to {switch}")
+    clock = event.clock
+    deadline = clock.monotonic() + timeout
+    pending = [i for i in sorted(event.sent) if i < len(pelt_psu)]
+    while pending:
+        for i in list(pending):
+            ch = pelt_psu[i]
             try:
-                pelt.state = bool(switch)
-                break  # If successful, break out of the retry loop
+                with throttle(ch):
+                    current = float(ch.measure_current.value)
+                    t = clock.time()
             except Exception as e:
-                logging.error(f"Error setting pelt{i} state: {e}")
+                logging.error(f"Error reading back pelt_psu{i}: {e}")
                 continue
-        time.sleep(SHORT_DELAY)
-        # s = pelt.state
-        # print(f"Pelt {i} : {s}")
+            if abs(current) < PELT_OFF_CURRENT:
+                event.confirmed[i] = t
+                pending.remove(i)
+        if clock.monotonic() >= deadline:
+            break
+
+PID_KEEPALIVE = 60.0    # seconds between health checks of the PID controller sessions
+
+class PIDSessions:
+    """Keeps the sessions to the PID controllers open for the whole run.
+    A keepalive thread reads every controller each PID_KEEPALIVE seconds and reconnects
+    any whose socket dropped, so cycles never pay the connection setup cost.
+    """
+    def __init__(self, pelts : list, keepalive = PID_KEEPALIVE, clock = WALL_CLOCK):
+        self.pelts = pelts
+        self.keepalive = keepalive
+        self.clock = clock
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pid-keepalive', daemon=True)
+
+    def open(self):
+        for pelt in self.pelts:
+            pelt.__enter__()
+        self._thread.start()
+
+    def close(self):
+        self._stopping.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        for pelt in self.pelts:
+            try:
+                pelt.__exit__(None, None, None)
+            except Exception as e:
+                logging.error(f"Error closing {pelt!r}: {e}")
+
+    def check(self) -> bool:
+        """Reads the state of every controller, reconnecting those that fail. Returns True if all are healthy."""
+        results = pid_group_command(self.pelts, lambda pelt: pelt.state)
+        for r in results:
+            if not r.ok:
+                logging.critical(f"PID controller {r.index} unhealthy: {r.error}")
+        return all(r.ok for r in results)
+
+    def _run(self):
+        while not self.clock.wait(self._stopping, self.keepalive):
+            self.check()
 
 def lvs_on_off(lvs : list, v : float, i : float, switch : bool):
     """ Turns the low voltage power supplies in the lvs list on or off, according to the value of switch.
@@ -68,15 +441,44 @@ def lvs_on_off(lvs : list, v : float, i : float, switch : bool):
         - i: current to set
         - switch: True for turning on, False for turning off 
     """
-    for i, lv in enumerate(lvs):
-        time.sleep(LONG_DELAY)
-        logging.debug(f"Setting lv{i} voltage to {v}V and current to {i}A")
-        lv.voltage = v
-        lv.current = i
-        lv.state = bool(switch)
-        time.sleep(SHORT_DELAY)
-        s = lv.state
-        print(f"LV {i} : {s}")
+    for n, lv in enumerate(lvs):
+        logging.debug(f"Setting lv{n} voltage to {v}V and current to {i}A")
+        with throttle(lv):
+            lv.voltage = v
+            lv.current = i
+            lv.state = bool(switch)
+        with throttle(lv):
+            s = lv.state
+        print(f"LV {n} : {s}")
+
+DEWPOINT_SENTINEL = -100.0  # dewpoint reported when the humidity reading is invalid (<= 0)
+
+def dewpoint_array(humidity, temp_85) -> np.ndarray:
+    """Vectorised dewpoint from humidity and temperature of the peltier back (Magnus formula).
+    Readings with humidity <= 0.00001 (the sensor's invalid value) are masked to DEWPOINT_SENTINEL.
+    Args:
+        humidity: relative humidity in %, scalar or array
+        temp_85: temperature of the peltier back in C, broadcastable against humidity
+    """
+    humidity = np.asarray(humidity, dtype=float)
+    temp_85 = np.asarray(temp_85, dtype=float)
+    valid = humidity > 0.00001
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gamma = np.log(np.where(valid, humidity, 100.0) / 100) + 17.625 * temp_85 / (243.04 + temp_85)
+        dewpoint = 243.04 * gamma / (17.625 - gamma)
+    return np.where(valid & np.isfinite(dewpoint), dewpoint, DEWPOINT_SENTINEL)
+
+def dewpoint_margin(humidity, temp_85, chuck_temp) -> tuple:
+    """Dewpoint and its margin against every chuck PT100 in one call.
+    Args:
+        humidity, temp_85: scalars, or arrays of shape (n,) for n readings
+        chuck_temp: chuck temperatures, shape (n_modules,) or (n, n_modules)
+    Returns:
+        A tuple (dewpoint, margin), with margin = chuck_temp - dewpoint per module.
+    """
+    dewpoint = dewpoint_array(humidity, temp_85)
+    margin = np.asarray(chuck_temp, dtype=float) - dewpoint[..., np.newaxis]
+    return dewpoint, margin
 
 def calc_dewpoint(humidity : float, temp_85 : float):
     """Calculates dewpoint from humidity and temperature of the peltier back.
@@ -85,18 +487,22 @@ def calc_dewpoint(humidity : float, temp_85 : float):
         humidity: relative humidity in %
         temp_85: temperature of the peltier back in C
     """
-    if type(humidity) is not float: # if the object has been passed, read the value
-        humidity = humidity.value if hasattr(humidity, 'value') else float(humidity)
-    if type(temp_85) is not float: # if the object has been passed, read the value
-        temp_85 = temp_85.value if hasattr(temp_85, 'value') else float(temp_85)
-        
-    if humidity <= 0.00001:
-        return -100.0
-    try:
-        return 243.04 * (math.log(humidity / 100) + 17.625 * temp_85 / (243.04 + temp_85)) / (17.625 - math.log(humidity / 100) - 17.625 * temp_85 / (243.04 + temp_85))
-    except Exception as e:
-        print(f'Exception: {e} with humi: {humidity} temp: {temp_85}')
-        return -100.0
+    if hasattr(humidity, 'value'): # if the object has been passed, read the value
+        humidity = humidity.value
+    if hasattr(temp_85, 'value'): # if the object has been passed, read the value
+        temp_85 = temp_85.value
+    return float(dewpoint_array(humidity, temp_85))
+
+def log_dewpoint_margins(path) -> tuple:
+    """Recomputes the dewpoint and its margin against every chuck PT100 over a whole run log.
+    Returns:
+        A tuple (time, dewpoint, margin) with margin of shape (rows, n_modules).
+    """
+    columns = load_runlog(path)
+    modules = [name.split(' ')[1] for name in columns if name.startswith('TEMP ')]
+    chuck_temp = np.column_stack([columns[f'TEMP {m}'] for m in modules])
+    dewpoint, margin = dewpoint_margin(columns['HUMI'], columns['SHT85 TEMP'], chuck_temp)
+    return columns['time'], dewpoint, margin
 
 def avg(instr : list) -> float:
     """Calculates the average of a list of instrument readings.
@@ -110,6 +516,323 @@ def avg(instr : list) -> float:
         return np.mean([instr[i].value for i in range(len(instr))])
     return np.mean(instr)
 
+@dataclass
+class InterlockReading:
+    """One readout of every ITkDCSInterlock channel used by the interlock.
+    Per-module lists are ordered like the modules passed to cli().
+    """
+    time: float
+    ntcs: list = field(default_factory=list)
+    chuck_temp: list = field(default_factory=list)
+    relay: list = field(default_factory=list)
+    humi: float = 0.0
+    temp_85: float = 0.0
+    lid: float = 0.0
+
+    @property
+    def dewpoint(self) -> float:
+        return calc_dewpoint(self.humi, self.temp_85)
+
+    @property
+    def dewpoint_margin(self) -> np.ndarray:
+        """Margin of every chuck PT100 above the dewpoint."""
+        return dewpoint_margin(self.humi, self.temp_85, self.chuck_temp)[1]
+
+def read_interlock(instruments) -> InterlockReading:
+    """Reads all NTC, PT100, relay, SHT85 and lid channels of the interlock once each.
+    The protocol has one query per channel, so this is still 3N+3 round trips on the
+    interlock socket; the gain is that every check works on the same typed reading.
+    Args:
+        instruments: class object containing list of instrument channels
+    Returns:
+        An InterlockReading with the values of every channel.
+    """
+    t = clock_of(instruments).time()
+    ntcs = [float(ch.value) for ch in instruments.ntcs]
+    chuck_temp = [float(ch.value) for ch in instruments.chuck_temp]
+    relay = [str(ch.value) for ch in instruments.ilock_relay]
+    humi = float(instruments.humi.value)
+    temp_85 = float(instruments.temp_85.value)
+    lid = float(instruments.lid.value)
+    return InterlockReading(t, ntcs, chuck_temp, relay, humi, temp_85, lid)
+
+@dataclass
+class PSUReading:
+    """Setpoints and measurements of a list of power supply channels, one entry per channel."""
+    voltage: list = field(default_factory=list)
+    current: list = field(default_factory=list)
+    measure_voltage: list = field(default_factory=list)
+    measure_current: list = field(default_factory=list)
+    status: list = field(default_factory=list)
+
+def read_psu(channels : list) -> PSUReading:
+    """Reads setpoints, measured values and status of every channel in the list, once each."""
+    reading = PSUReading()
+    for ch in channels:
+        reading.voltage.append(float(ch.voltage))
+        reading.current.append(float(ch.current))
+        reading.measure_voltage.append(float(ch.measure_voltage.value))
+        reading.measure_current.append(float(ch.measure_current.value))
+        reading.status.append(ch.status)
+    return reading
+
+@dataclass
+class Snapshot:
+    """Timestamped reading of the test box, taken once per control tick and handed
+    to every consumer of that tick (interlock, ramp loops and logging) so that no
+    value is read from the bus twice and all of them see the same numbers.
+    The PSU readings are only filled in when requested, as the ramps do not need them.
+    """
+    time: float
+    interlock: InterlockReading
+    lv: PSUReading = None
+    pelt: PSUReading = None
+    chiller: float = None
+
+    @property
+    def ntcs(self) -> list:
+        return self.interlock.ntcs
+
+    @property
+    def chuck_temp(self) -> list:
+        return self.interlock.chuck_temp
+
+    @property
+    def dewpoint(self) -> float:
+        return self.interlock.dewpoint
+
+HUBER_KEEPALIVE = 30.0  # seconds between keepalive reads of the Huber chiller
+
+class Chiller:
+    """Holds the HuberCC508 session open for the whole run instead of entering it for every
+    statement. Commands go through the huber bus, so they are serialised with the snapshot
+    reads, and are retried once after a reconnect if they fail. The last commanded setpoint,
+    speed and state are cached so they can be logged without another transaction.
+    """
+    def __init__(self, channel, bus = None, keepalive = HUBER_KEEPALIVE, clock = WALL_CLOCK):
+        self.channel = channel
+        self.bus = bus
+        self.keepalive = keepalive
+        self.clock = clock
+        self._setpoint = None
+        self._speed = None
+        self._state = None
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='huber-keepalive', daemon=True)
+
+    def open(self):
+        self.channel.__enter__()
+        self._thread.start()
+
+    def close(self):
+        self._stopping.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        try:
+            self.channel.__exit__(None, None, None)
+        except Exception as e:
+            logging.error(f"Error closing the Huber session: {e}")
+
+    def _transaction(self, fn):
+        try:
+            with throttle(self.channel):
+                return fn(self.channel)
+        except Exception as e:
+            logging.error(f"Huber transaction failed, reconnecting: {e}")
+            reconnect(self.channel)
+            with throttle(self.channel):
+                return fn(self.channel)
+
+    def _call(self, fn):
+        if self.bus is not None:
+            return self.bus.call(self._transaction, fn)
+        return self._transaction(fn)
+
+    def submit_read(self):
+        """Queues a temperature read on the huber bus. Returns a future-like object with a result() method."""
+        read = lambda ch: float(ch.temperature)
+        if self.bus is not None:
+            return self.bus.submit(self._transaction, read)
+        return _Done(self._transaction(read))
+
+    def read_temperature(self) -> float:
+        return self.submit_read().result()
+
+    @property
+    def setpoint(self):
+        return self._setpoint
+
+    @setpoint.setter
+    def setpoint(self, value):
+        self._call(lambda ch: setattr(ch, 'temperature', value))
+        self._setpoint = value
+
+    @property
+    def speed(self):
+        return self._speed
+
+    @speed.setter
+    def speed(self, value):
+        self._call(lambda ch: setattr(ch, 'speed', value))
+        self._speed = value
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self._call(lambda ch: setattr(ch, 'state', value))
+        self._state = value
+
+    def _run(self):
+        while not self.clock.wait(self._stopping, self.keepalive):
+            try:
+                self.read_temperature()
+            except Exception as e:
+                logging.critical(f"Huber chiller unreachable: {e}")
+
+def take_snapshot(instruments, psus = False, max_age = None) -> Snapshot:
+    """Builds the Snapshot for the current tick.
+    Each bus is read by its own worker, so the tick takes as long as the slowest bus
+    rather than the sum of all of them.
+    Args:
+        instruments: class object containing list of instrument channels
+        psus: also read the LV and peltier power supplies and the chiller (needed for logging)
+        max_age: reuse the last interlock reading if it is younger than this many seconds,
+            instead of reading the interlock again. Defaults to instruments.interlock_max_age,
+            the watchdog period plus its deadline while the InterlockWatchdog runs, else 0.
+    """
+    if max_age is None:
+        max_age = getattr(instruments, 'interlock_max_age', 0.0)
+    last = getattr(instruments, 'last_interlock', None)
+    if last is not None and clock_of(instruments).time() - last.time < max_age:
+        interlock = _Done(last)
+    else:
+        interlock = on_bus(instruments, 'interlock', read_interlock, instruments)
+    if psus:
+        lv = on_bus(instruments, 'lv_psu', read_psu, instruments.lvs)
+        pelt = on_bus(instruments, 'pelt_psu', read_psu, instruments.pelt_psu)
+        chiller = instruments.huber.submit_read()
+    interlock = interlock.result()
+    instruments.last_interlock = interlock
+    if not psus:
+        snapshot = Snapshot(interlock.time, interlock)
+    else:
+        snapshot = Snapshot(interlock.time, interlock, lv.result(), pelt.result(), chiller.result())
+    telemetry = getattr(instruments, 'telemetry', None)
+    if telemetry is not None:
+        telemetry.append(snapshot)
+    return snapshot
+
+TELEMETRY_CAPACITY = 32768  # rows of history kept in memory
+
+def telemetry_dtype(n_modules : int) -> np.dtype:
+    """Structured row of the telemetry buffer. Per-module fields are vectors of length n_modules."""
+    per_module = (np.float64, (n_modules,))
+    return np.dtype([
+        ('time', np.int64),                 # ns since the epoch
+        ('ntc', per_module),
+        ('pt100', per_module),
+        ('humi', np.float64),
+        ('temp_85', np.float64),
+        ('dewpoint', np.float64),
+        ('lid', np.float64),
+        ('chiller', np.float64),
+        ('relay_trip', np.bool_, (n_modules,)),
+        ('lv_voltage', per_module),
+        ('lv_current', per_module),
+        ('lv_measure_voltage', per_module),
+        ('lv_measure_current', per_module),
+        ('pelt_voltage', per_module),
+        ('pelt_current', per_module),
+        ('pelt_measure_voltage', per_module),
+        ('pelt_measure_current', per_module),
+    ])
+
+class TelemetryBuffer:
+    """Fixed-memory ring buffer of Snapshots as a NumPy structured array.
+    Every row is stored twice, capacity rows apart, so the latest n rows are always one
+    contiguous slice: appends are O(1) and windows are zero-copy views. The views are only
+    valid until the rows they cover are overwritten, copy them to keep them longer.
+    Fields missing from a snapshot (e.g. the PSUs on a control tick) are NaN.
+    Rows are kept in strictly increasing time order, as since() relies on: a snapshot that is
+    not newer than the last row (one that reused an interlock reading) is not appended, it only
+    fills in the fields the last row is missing.
+    """
+    def __init__(self, n_modules : int, capacity = TELEMETRY_CAPACITY):
+        self.capacity = capacity
+        self.dtype = telemetry_dtype(n_modules)
+        self._data = np.zeros(2 * capacity, dtype=self.dtype)
+        self._next = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, snapshot : Snapshot):
+        row = np.zeros((), dtype=self.dtype)
+        row['time'] = int(snapshot.time * 1e9)
+        reading = snapshot.interlock
+        row['ntc'] = reading.ntcs
+        row['pt100'] = reading.chuck_temp
+        row['humi'] = reading.humi
+        row['temp_85'] = reading.temp_85
+        row['dewpoint'] = reading.dewpoint
+        row['lid'] = reading.lid
+        row['relay_trip'] = ["TRIP" in r for r in reading.relay]
+        row['chiller'] = snapshot.chiller if snapshot.chiller is not None else np.nan
+        for prefix, psu in (('lv', snapshot.lv), ('pelt', snapshot.pelt)):
+            for name in ('voltage', 'current', 'measure_voltage', 'measure_current'):
+                row[f'{prefix}_{name}'] = getattr(psu, name) if psu is not None else np.nan
+        with self._lock:
+            if self.count:
+                last = (self._next - 1) % self.capacity
+                if row['time'] <= self._data['time'][last]:
+                    self._merge(last, row)
+                    return
+            self._data[self._next] = row
+            self._data[self._next + self.capacity] = row
+            self._next = (self._next + 1) % self.capacity
+            self.count += 1
+
+    def _merge(self, i, row):
+        for name in self.dtype.names:
+            if self.dtype[name].base.kind != 'f':
+                continue
+            column = self._data[name]
+            column[i] = np.where(np.isnan(column[i]), row[name], column[i])
+            column[i + self.capacity] = column[i]
+
+    def window(self, n = None) -> np.ndarray:
+        """Zero-copy view of the latest n rows (all of them if None), oldest first."""
+        with self._lock:
+            n = len(self) if n is None else min(n, len(self))
+            end = self._next + self.capacity
+            return self._data[end - n:end]
+
+    def since(self, seconds : float) -> np.ndarray:
+        """Zero-copy view of the rows of the last seconds."""
+        rows = self.window()
+        if not len(rows):
+            return rows
+        start = np.searchsorted(rows['time'], rows['time'][-1] - int(seconds * 1e9))
+        return rows[start:]
+
+    def rate(self, field : str, seconds : float) -> np.ndarray:
+        """Least-squares rate of change of a field over the last seconds, in units per minute.
+        Per-module fields give one rate per module. NaN if there are fewer than two rows.
+        """
+        rows = self.since(seconds)
+        values = rows[field]
+        if len(rows) < 2:
+            return np.full(values.shape[1:], np.nan)
+        t = (rows['time'] - rows['time'][0]) / 60e9
+        t = t - t.mean()
+        values = values - values.mean(axis=0)
+        return np.tensordot(t, values, axes=(0, 0)) / np.dot(t, t)
+
 def read_instrument_values(instr : list) -> list:
     """Reads the values from a list of instrument objects.
     If the instrument has a value attribute, it will read the value from each channel.
@@ -122,58 +845,188 @@ def read_instrument_values(instr : list) -> list:
         return [instr[i].value for i in range(len(instr))]
     return instr
 
-def log_information(fl, instruments, HEADER, write_api):
+LOG_CHUNK_ROWS = 256        # rows buffered in memory before a run log flush
+LOG_FLUSH_INTERVAL = 30.0   # seconds a row may stay in memory before a run log flush
+LOG_FSYNC = 'chunk'         # fsync the run log after every 'chunk', only on 'close', or 'never'
+NPY_HEADER_SIZE = 128       # fixed .npy header size, so the shape can be rewritten in place
+
+def npy_header(dtype : np.dtype, shape : tuple) -> bytes:
+    """.npy version 1.0 header padded to NPY_HEADER_SIZE bytes."""
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+class ColumnarLog:
+    """Run log stored as a directory with one appendable .npy file per column.
+    Rows are buffered and written in chunks of LOG_CHUNK_ROWS, or as soon as the oldest
+    buffered row is LOG_FLUSH_INTERVAL seconds old, so a crash loses at most that much of a
+    slowly filling log; after each chunk the .npy headers are rewritten with the new length, so the files are valid at any time and load
+    with np.load(..., mmap_mode='r') without parsing. The time column holds int64 ns since
+    the epoch. columns.json lists the columns in order; use runlog_to_csv() to get a CSV.
+    Args:
+        path: directory of the run log, created if needed
+        columns: list of (name, dtype, shape) with the shape of one row of the column
+        chunk_rows: rows buffered before a flush
+        flush_interval: seconds the oldest buffered row may wait before a flush
+        fsync: 'chunk' to fsync after every flush, 'close' to fsync only when closing, 'never'
+        clock: run clock the flush interval is timed on
+    """
+    def __init__(self, path, columns : list, chunk_rows = LOG_CHUNK_ROWS, fsync = LOG_FSYNC, flush_interval = LOG_FLUSH_INTERVAL,
+                 clock = WALL_CLOCK):
+        if fsync not in ('chunk', 'close', 'never'):
+            raise ValueError(f"Unknown fsync policy {fsync!r}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.clock = clock
+        self.rows = 0
+        self._filled = 0
+        self._first_buffered = None
+        self._lock = threading.Lock()
+        self._columns = []
+        for name, dtype, shape in columns:
+            dtype, shape = np.dtype(dtype), tuple(shape)
+            fl = open(os.path.join(path, column_file(name)), 'wb')
+            fl.write(npy_header(dtype, (0, *shape)))
+            self._columns.append((name, dtype, shape, fl, np.zeros((chunk_rows, *shape), dtype=dtype)))
+        with open(os.path.join(path, 'columns.json'), 'w') as index:
+            json.dump([name for name, *_ in columns], index)
+
+    def append(self, row):
+        """Appends one row, given as a sequence of values in the order of the columns."""
+        with self._lock:
+            for (name, dtype, shape, fl, buf), value in zip(self._columns, row):
+                buf[self._filled] = value
+            if not self._filled:
+                self._first_buffered = self.clock.monotonic()
+            self._filled += 1
+            if self._filled == self.chunk_rows or self.clock.monotonic() - self._first_buffered >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._filled:
+            return
+        self.rows += self._filled
+        for name, dtype, shape, fl, buf in self._columns:
+            fl.write(buf[:self._filled].tobytes())
+            fl.seek(0)
+            fl.write(npy_header(dtype, (self.rows, *shape)))
+            fl.seek(0, os.SEEK_END)
+            fl.flush()
+            if self.fsync == 'chunk':
+                os.fsync(fl.fileno())
+        self._filled = 0
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            for name, dtype, shape, fl, buf in self._columns:
+                if self.fsync != 'never':
+                    os.fsync(fl.fileno())
+                fl.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def column_file(name : str) -> str:
+    return name.replace(' ', '_') + '.npy'
+
+def load_runlog(path) -> dict:
+    """Loads a ColumnarLog directory as a dict of column name to memory-mapped array, in column order."""
+    with open(os.path.join(path, 'columns.json')) as index:
+        names = json.load(index)
+    return {name: np.load(os.path.join(path, column_file(name)), mmap_mode='r') for name in names}
+
+def runlog_to_csv(path, csv_path = None) -> str:
+    """Converts a ColumnarLog directory to the CSV layout of the old _Interlock_log.csv files.
+    Per-module columns are written as one CSV column per module. Returns the CSV path.
+    """
+    columns = load_runlog(path)
+    if csv_path is None:
+        csv_path = path.rstrip(os.sep) + '.csv'
+    names, values = [], []
+    for name, data in columns.items():
+        if name == 'time':
+            names.append(name)
+            values.append([str(datetime.datetime.utcfromtimestamp(t / 1e9)) for t in data])
+        elif data.ndim == 1:
+            names.append(name)
+            values.append(data)
+        else:
+            for i in range(data.shape[1]):
+                names.append(f"{name} {i}")
+                values.append(data[:, i])
+    with open(csv_path, 'w') as fl:
+        fl.write(', '.join(names) + '\n')
+        for row in zip(*values):
+            fl.write(', '.join(str(v) for v in row) + '\n')
+    return csv_path
+
+LOG_FIELDS = ['NTC', 'HUMI', 'TEMP', 'DEWPOINT', 'LV VOLT', 'LV CURR', 'PELT VOLT', 'PELT CURR', 'HV VOLT', 'HV CURR', 'SHT85 TEMP']
+MODULE_FIELDS = ['NTC', 'TEMP', 'LV VOLT', 'LV CURR', 'PELT VOLT', 'PELT CURR', 'RELAY']
+
+def build_header(modules : list) -> list:
+    """Log columns and database fields for the active modules: time, the averages over all
+    modules (as in the original log), then MODULE_FIELDS for each module, e.g. 'NTC 3'.
+    """
+    return ['time', *LOG_FIELDS, *[f'{name} {m}' for m in modules for name in MODULE_FIELDS]]
+
+def log_information(fl, instruments, HEADER, write_api, snapshot = None):
     """Logs the current state of the instruments to a file and optionally to a instruments.database.
     Args:
-        fl: file object to write the log to
-        ntcs: list of NTC temperature sensors
-        lvs: list of low voltage power supplies
-        pelt_psu: list of Peltier power supplies
-        hvs: list of high voltage power supplies
-        humi: humidity sensor
-        chuck_temp: list of chuck temperature sensors
-        HEADER: list of header names for the log file
+        fl: ColumnarLog to write the log to
+        instruments: class object containing list of instrument channels
+        HEADER: list of header names for the log file, from build_header()
         write_api: InfluxDB write API object for logging to a instruments.database
-        temp_85: temperature of the peltier back
+        snapshot: Snapshot of the current tick, including the PSU readings. A new one is taken if None.
     """
+    if snapshot is None or snapshot.lv is None or snapshot.pelt is None:
+        snapshot = take_snapshot(instruments, psus=True)
     outstring=[]
-    outstring_time=datetime.datetime.utcfromtimestamp(time.time())
+    outstring_time=datetime.datetime.utcfromtimestamp(snapshot.time)
     outstring.append(outstring_time)
     
     # Read monitoring values into file or something
-    logging.info(f"NTCs: {avg(instruments.ntcs):.2f}°C")
-    outstring.append(avg(instruments.ntcs))
+    ntc = avg(snapshot.ntcs)
+    logging.info(f"NTCs: {ntc:.2f}°C")
+    outstring.append(ntc)
     
-    humidity = instruments.humi.value
+    humidity = snapshot.interlock.humi
     logging.info(f"HUMI: {humidity}\%")
     outstring.append(humidity)
     
-    logging.info(f"TEMP: {avg(instruments.chuck_temp):.2f}°C")
-    outstring.append(avg(instruments.chuck_temp))
+    chuck_temp = avg(snapshot.chuck_temp)
+    logging.info(f"TEMP: {chuck_temp:.2f}°C")
+    outstring.append(chuck_temp)
     
-    dewpoint = calc_dewpoint(humidity, instruments.temp_85)
+    dewpoint = snapshot.dewpoint
     logging.info(f"DEWP: {dewpoint:.2f}°C")
     outstring.append(dewpoint)
     
-    avg_voltage = lambda x: np.mean([x[i].voltage for i in range(len(x))])
-    avg_current = lambda x: np.mean([x[i].current for i in range(len(x))])
-    avg_measure_voltage = lambda x: np.mean([x[i].measure_voltage.value for i in range(len(x))])
-    avg_measure_current = lambda x: np.mean([x[i].measure_current.value for i in range(len(x))])
-    
-    logging.info(f"LV setpoint: {avg_voltage(instruments.lvs):.2f}V, {avg_current(instruments.lvs):.2f}A")
-    logging.info(f"LV actual: {avg_measure_voltage(instruments.lvs):.2f}V, {avg_measure_current(instruments.lvs):.2f}A")
+    lv, pelt = snapshot.lv, snapshot.pelt
+    logging.info(f"LV setpoint: {avg(lv.voltage):.2f}V, {avg(lv.current):.2f}A")
+    logging.info(f"LV actual: {avg(lv.measure_voltage):.2f}V, {avg(lv.measure_current):.2f}A")
     
-    outstring.append(avg_voltage(instruments.lvs))
-    outstring.append(avg_current(instruments.lvs))
+    outstring.append(avg(lv.voltage))
+    outstring.append(avg(lv.current))
     
-    logging.info(f"PELT setpoint: {avg_voltage(instruments.pelt_psu):.2f}V, {avg_current(instruments.pelt_psu):.2f}A")
-    logging.info(f"PELT actual: {avg_measure_voltage(instruments.pelt_psu):.2f}V, {avg_measure_current(instruments.pelt_psu):.2f}A")
+    logging.info(f"PELT setpoint: {avg(pelt.voltage):.2f}V, {avg(pelt.current):.2f}A")
+    logging.info(f"PELT actual: {avg(pelt.measure_voltage):.2f}V, {avg(pelt.measure_current):.2f}A")
     
-    outstring.append(avg_measure_voltage(instruments.pelt_psu))
-    outstring.append(avg_measure_current(instruments.pelt_psu))
+    outstring.append(avg(pelt.measure_voltage))
+    outstring.append(avg(pelt.measure_current))
 
     #outstring.append(0.0) # ONLY WHILE THE REST IS COMMENTED OUT
-    logging.info(f"PELT status: {[instruments.pelt_psu[i].status for i in range(len(instruments.pelt_psu))]!r}")
+    logging.info(f"PELT status: {pelt.status!r}")
 
     #logging.info("HV setpoint: {hvs[0].voltage}, {hvs[0].current}")
     #print('HV State', hvs[0].state)
@@ -191,45 +1044,268 @@ def log_information(fl, instruments, HEADER, write_api):
     outstring.append(0.0) # JAY: to delete
     outstring.append(0.0) # JAY: to delete
     
-    for i in outstring[:-1]:
-        fl.write(str(i)+', ')
-    fl.write(str(outstring[-1])+'\n')
+    outstring.append(snapshot.interlock.temp_85)
+    
+    # Per-module values, in the order of MODULE_FIELDS
+    relay = [float("TRIP" in r) for r in snapshot.interlock.relay]
+    logging.info(f"NTC per module: {snapshot.ntcs!r}")
+    for values in zip(snapshot.ntcs, snapshot.chuck_temp, lv.voltage, lv.current, pelt.measure_voltage, pelt.measure_current, relay):
+        outstring.extend(values)
+    
+    fl.append([int(snapshot.time * 1e9), *outstring[1:]])
     dictionary={
         "measurement":'4-module testbox software',
-        "tags":{'location':'OPMD-cleanroom-main'},
-        "fields": {k: v for k, v in zip(HEADER[1:], outstring[1:])}, #time, NTC, HUMI, TEMP, DEWPOINT, LV VOLT, LV CURR, PELT VOLT, PELT CURR, HV VOLT, HV CURR
+        "tags":{'location':'OPMD-cleanroom-main', **({'box': BOX_NAME} if BOX_NAME else {})},
+        "fields": {k: v for k, v in zip(HEADER[1:], outstring[1:])}, #time, LOG_FIELDS, MODULE_FIELDS per module
         "time": outstring[0]
     }
     write_to_db(write_api, dictionary)
 
-def interlock_test(instruments : Instruments, mini_ramp_up, temp):
+LATENCY_BINS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60]   # upper bin edges in seconds
+
+class LatencyHistogram:
+    """Running histogram of latencies, with fixed bins so it stays the same size however long the run."""
+    def __init__(self, bins = LATENCY_BINS):
+        self.bins = np.asarray(bins, dtype=float)
+        self.counts = np.zeros(len(self.bins) + 1, dtype=int)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds : float):
+        self.counts[np.searchsorted(self.bins, seconds)] += 1
+        self.n += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def __str__(self):
+        edges = [f"<={b:g}s" for b in self.bins] + [f">{self.bins[-1]:g}s"]
+        counts = ', '.join(f"{e}: {c}" for e, c in zip(edges, self.counts) if c)
+        return f"n={self.n} mean={1000 * self.total / max(self.n, 1):.0f}ms max={1000 * self.max:.0f}ms [{counts}]"
+
+class InterlockEvent:
+    """Timestamps of one interlock reaction, from the sensor read to the peltiers confirmed off.
+    sent and confirmed map the index of each device to the time its off command completed
+    and the time its peltier supply output was read back as off.
+    """
+    def __init__(self, cause, read_time = None, clock = WALL_CLOCK):
+        self.cause = cause
+        self.clock = clock
+        self.decided = clock.time()
+        self.read = read_time if read_time is not None else self.decided
+        self.sent = {}
+        self.confirmed = {}
+
+    def breakdown(self) -> dict:
+        """Latency of every step, in seconds since the sensor read."""
+        stages = {'decision': self.decided - self.read}
+        for i, t in sorted(self.sent.items()):
+            stages[f'sent{i}'] = t - self.read
+        for i, t in sorted(self.confirmed.items()):
+            stages[f'off{i}'] = t - self.read
+        if self.confirmed:
+            stages['total'] = max(self.confirmed.values()) - self.read
+        return stages
+
+class LatencyStats:
+    """Running histograms of interlock reaction latencies, per stage:
+    decision, command (each device), confirm (each device) and total.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, event : InterlockEvent):
+        breakdown = event.breakdown()
+        logging.critical(f"Interlock reaction ({event.cause}): " + ', '.join(f"{k} {1000 * v:.0f}ms" for k, v in breakdown.items()))
+        if len(event.confirmed) < len(event.sent):
+            logging.critical(f"Interlock reaction ({event.cause}): only {len(event.confirmed)} of {len(event.sent)} devices confirmed off")
+        with self._lock:
+            for k, v in breakdown.items():
+                stage = 'command' if k.startswith('sent') else 'confirm' if k.startswith('off') else k
+                self.histograms.setdefault(stage, LatencyHistogram()).add(v)
+
+    def summary(self) -> str:
+        with self._lock:
+            return '\n'.join(f"  {stage}: {h}" for stage, h in self.histograms.items())
+
+interlock_latency = LatencyStats()
+
+BUS_LATENCY_BINS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]   # upper bin edges in seconds
+
+class BusProfiler:
+    """Opt-in profile of the instrument traffic (--profile): call counts and latency histograms
+    of every channel property read, write and method call, per instrument, channel and operation.
+    Reads are recorded as 'name', writes as 'name=' and calls as 'name()'.
+    """
+    def __init__(self, clock = WALL_CLOCK):
+        self.histograms = {}        # (instrument, channel, operation) -> LatencyHistogram
+        self.clock = clock
+        self.started = clock.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, instrument, channel, operation, seconds):
+        with self._lock:
+            key = (instrument, channel, operation)
+            if key not in self.histograms:
+                self.histograms[key] = LatencyHistogram(BUS_LATENCY_BINS)
+            self.histograms[key].add(seconds)
+
+    def wrap(self, channel, instrument, label):
+        return ProfiledChannel(channel, self, instrument, label)
+
+    def totals(self) -> dict:
+        """Calls and busy seconds per instrument."""
+        totals = {}
+        with self._lock:
+            for (instrument, _, _), h in self.histograms.items():
+                calls, busy = totals.get(instrument, (0, 0.0))
+                totals[instrument] = (calls + h.n, busy + h.total)
+        return totals
+
+    def summary(self) -> str:
+        elapsed = self.clock.monotonic() - self.started
+        lines = [f"Bus profile over {elapsed:.0f}s:"]
+        totals = self.totals()
+        with self._lock:
+            items = sorted(self.histograms.items(), key=lambda item: -item[1].total)
+        for instrument, (calls, busy) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            lines.append(f"  {instrument}: {calls} calls, {busy:.1f}s busy ({100 * busy / max(elapsed, 1e-9):.0f}% of the run)")
+            for (inst, channel, operation), h in items:
+                if inst == instrument:
+                    lines.append(f"    {channel} {operation}: {h}")
+        return '\n'.join(lines)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {f"{instrument}/{channel}/{operation}": {'n': h.n, 'total': h.total, 'max': h.max,
+                                                             'counts': h.counts.tolist(), 'bins': BUS_LATENCY_BINS}
+                    for (instrument, channel, operation), h in self.histograms.items()}
+
+class ProfiledChannel:
+    """Stands in for an instrument channel and times every property read, property write and
+    method call on it for a BusProfiler. Attributes that are objects themselves (measure_voltage)
+    are wrapped in turn, so their reads are recorded as e.g. 'measure_voltage.value'.
+    """
+    def __init__(self, channel, profiler, instrument, label, prefix = ''):
+        object.__setattr__(self, '_channel', channel)
+        object.__setattr__(self, '_profiler', profiler)
+        object.__setattr__(self, '_instrument', instrument)
+        object.__setattr__(self, '_label', label)
+        object.__setattr__(self, '_prefix', prefix)
+
+    def _record(self, operation, start):
+        self._profiler.record(self._instrument, self._label, self._prefix + operation, self._profiler.clock.perf_counter() - start)
+
+    def __getattr__(self, name):
+        start = self._profiler.clock.perf_counter()
+        value = getattr(self._channel, name)
+        if callable(value):
+            def timed(*args, **kwargs):
+                start = self._profiler.clock.perf_counter()
+                try:
+                    return value(*args, **kwargs)
+                finally:
+                    self._record(f"{name}()", start)
+            return timed
+        if isinstance(getattr(type(value), 'value', None), property):   # a measurement channel, read through its value
+            return ProfiledChannel(value, self._profiler, self._instrument, self._label, f"{self._prefix}{name}.")
+        self._record(name, start)
+        return value
+
+    def __setattr__(self, name, value):
+        start = self._profiler.clock.perf_counter()
+        try:
+            setattr(self._channel, name, value)
+        finally:
+            self._record(f"{name}=", start)
+
+    def __enter__(self):
+        start = self._profiler.clock.perf_counter()
+        self._channel.__enter__()
+        self._record('open', start)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        start = self._profiler.clock.perf_counter()
+        try:
+            return self._channel.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self._record('close', start)
+
+bus_profiler = None         # BusProfiler of the run, with --profile
+
+def profile_channels(channels : dict, inst_modules : list, profiler : BusProfiler) -> dict:
+    """Wraps every channel from open_channels() in a ProfiledChannel, labelled by its
+    Instruments attribute and module number, e.g. 'ntcs 3'.
+    """
+    wrapped = dict(channels)
+    for key, instrument in [('ntcs', 'interlock'), ('ilock_relay', 'interlock'), ('chuck_temp', 'interlock'),
+                            ('lvs', 'lv_psu'), ('pelt_psu', 'pelt_psu'), ('pelts', 'pid')]:
+        wrapped[key] = [profiler.wrap(ch, instrument, f"{key} {m}") for ch, m in zip(channels[key], inst_modules)]
+    for key, instrument in [('humi', 'interlock'), ('temp_85', 'interlock'), ('lid', 'interlock'), ('base', 'huber'), ('chiller', 'huber')]:
+        wrapped[key] = profiler.wrap(channels[key], instrument, key)
+    wrapped['hvs'] = [profiler.wrap(ch, 'hv_psu', f"hvs {n}") for n, ch in enumerate(channels['hvs'], 1)]
+    return wrapped
+
+def profile_handler(sig, frame):
+    # SIGUSR1 prints the bus profile so far
+    if bus_profiler is not None:
+        print(bus_profiler.summary(), flush=True)
+
+def interlock_cause(reading : InterlockReading) -> str:
+    """Evaluates the hard interlock conditions on a reading, without acting on anything.
+    Returns:
+        The cause of the interlock ('Temperature', 'Dewpoint', 'Open Lid', 'HW Interlock'),
+        or an empty string if none is met.
+    """
+    if any([t > 70 for t in reading.ntcs]):
+        return 'Temperature'
+    if np.any(reading.dewpoint_margin < 2):
+        return 'Dewpoint'
+    if reading.lid < 4:
+        return 'Open Lid'
+    if any(["TRIP" in r for r in reading.relay]):
+        return 'HW Interlock'
+    return ''
+
+def interlock_test(instruments : Instruments, mini_ramp_up, temp, snapshot = None):
     """Checks the interlock conditions and returns whether an interlock condition is met.
     Args:
         instruments: class object containing list of instrument channels
         mini_ramp_up: boolean indicating if mini ramp up is active
         temp: current temperature
+        snapshot: Snapshot of the current tick. A new one is taken if None.
     Returns:
         A tuple (interlock_condition, cause, mini_ramp_up) where:
         - interlock_condition: True if an interlock condition is met, False otherwise
         - cause: string indicating the cause of the interlock condition, or an empty string if no condition is met
         - mini_ramp_up: boolean indicating if mini ramp up was triggered
     """
-    dewpoint = calc_dewpoint(instruments.humi.value, instruments.temp_85.value)
-    ntc_vals = read_instrument_values(instruments.ntcs)
-    chuck_temp_vals = read_instrument_values(instruments.chuck_temp)
-    relay_vals = read_instrument_values(instruments.ilock_relay)
-    #print(f"{relay_vals=}")
-    if any([t > 70 for t in ntc_vals]):
+    if snapshot is None:
+        snapshot = take_snapshot(instruments)
+    clock = clock_of(instruments)
+    reading = snapshot.interlock
+    dewpoint, margin = dewpoint_margin(reading.humi, reading.temp_85, reading.chuck_temp)
+    ntc_vals = reading.ntcs
+    chuck_temp_vals = reading.chuck_temp
+    cause = interlock_cause(reading)  # the same decision as the watchdog's
+    if cause == 'Temperature':
+        event = InterlockEvent('Temperature', reading.time, clock)
         logging.critical('Interlock triggered due to NTC temp > 70')
-        pelts_on_off(instruments.pelts, False)
+        pelts_on_off(instruments.pelts, False, event, instruments.pelt_psu)
+        interlock_latency.record(event)
         return True, 'Temperature', mini_ramp_up, temp
     if any([t > 65 for t in ntc_vals]) and any(pelts_read(instruments.pelts)):
-        pelts_on_off(instruments.pelts, switch=False)
+        event = InterlockEvent('NTC > 65', reading.time, clock)
+        pelts_on_off(instruments.pelts, switch=False, event=event, pelt_psu=instruments.pelt_psu)
+        interlock_latency.record(event)
         logging.critical('Peltier turned off due to NTC temp > 65')
-    if any([dewpoint > ch_t - 2 for ch_t in chuck_temp_vals]):
+    if cause == 'Dewpoint':
+        interlock_latency.record(InterlockEvent('Dewpoint', reading.time, clock))
         logging.critical('Interlock triggered due to chuck temp > dewpoint + 2')
         return True, 'Dewpoint', mini_ramp_up, temp
-    elif any([dewpoint > ch_t - 5 for ch_t in chuck_temp_vals]):
+    elif np.any(margin < MINI_RAMP_MARGIN):
         print(f"{dewpoint=}")
         print(f"{chuck_temp_vals=}")
         if mini_ramp_up == False:
@@ -237,35 +1313,161 @@ def interlock_test(instruments : Instruments, mini_ramp_up, temp):
             mini_ramp_up = True
             logging.critical('Target temperature increased due to chuck temp > dewpoint + 5')
         
-    if instruments.lid.value < 4:
-        pelts_on_off(instruments.pelts, False)
-        time.sleep(2)
+    if cause == 'Open Lid':
+        event = InterlockEvent('Open Lid', reading.time, clock)
+        pelts_on_off(instruments.pelts, False, event, instruments.pelt_psu)
+        interlock_latency.record(event)
+        clock.sleep(2)
         logging.critical('Interlock triggered due to lid voltage < 4V')
         return True, 'Open Lid', mini_ramp_up, temp
     
-    if "TRIP" in relay_vals[0]:
-        time.sleep(2)
-        pelts_on_off(instruments.pelts, False)
-        time.sleep(2)
+    if cause == 'HW Interlock':
+        event = InterlockEvent('HW Interlock', reading.time, clock)
+        clock.sleep(2)
+        pelts_on_off(instruments.pelts, False, event, instruments.pelt_psu)
+        interlock_latency.record(event)
+        clock.sleep(2)
         logging.critical('Hardware interlock triggered')
         return True, 'HW Interlock', mini_ramp_up, temp
     
     return False, '', mini_ramp_up, temp
 
+class InterlockWatchdog(threading.Thread):
+    """Evaluates the hard interlock conditions at a fixed rate, independently of the ramp logic,
+    so that they are also checked during chiller pauses, peltier switching and between cycles.
+    Each check must complete within the deadline; too many missed deadlines in a row trip the
+    watchdog as well. A read that missed its deadline is waited on by the next check rather
+    than queueing a second read behind it on the interlock bus. On a trip the peltiers are switched off directly and please_abort is set
+    to stop the control loop.
+    Every reading is published as instruments.last_interlock, and the control ticks reuse the
+    latest one instead of reading the interlock again, unless the watchdog has fallen behind.
+    """
+    def __init__(self, instruments, period = WATCHDOG_PERIOD, deadline = WATCHDOG_DEADLINE, max_misses = WATCHDOG_MAX_MISSES):
+        super().__init__(name='interlock-watchdog', daemon=True)
+        self.instruments = instruments
+        self.clock = clock_of(instruments)
+        self.period = period
+        self.deadline = deadline
+        self.max_misses = max_misses
+        self.tripped = threading.Event()
+        self.cause = ''
+        self.reading = None
+        self.checks = 0
+        self.misses = 0
+        self._pending = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        # readings are stamped when their read starts, which may take up to the deadline
+        self.instruments.interlock_max_age = self.period + self.deadline
+        super().start()
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+        self.instruments.interlock_max_age = 0.0
+
+    def run(self):
+        tick = ticker('interlock watchdog', self.period, self._stopping, self.clock)
+        missed = 0
+        while not self._stopping.is_set():
+            cause = self.check()
+            if cause is None:
+                missed += 1
+                self.misses += 1
+                logging.error(f"Interlock watchdog missed its {self.deadline}s deadline ({missed} in a row)")
+                if missed >= self.max_misses:
+                    cause = 'Watchdog timeout'
+            else:
+                missed = 0
+            if cause:
+                self.trip(cause)
+                return
+            tick.wait()
+
+    def check(self):
+        """Reads the interlock and evaluates it. Returns the cause, '' if all is well, or None if the deadline was missed."""
+        if self._pending is None:
+            self._pending = on_bus(self.instruments, 'interlock', read_interlock, self.instruments)
+        timeout = max(self.deadline / self.clock.speed, min(self.deadline, WATCHDOG_WALL_FLOOR))
+        try:
+            self.reading = self._pending.result(timeout=timeout)
+        except FutureTimeout:
+            return None
+        except Exception as e:
+            logging.error(f"Interlock watchdog read failed: {e}")
+            self._pending = None
+            return None
+        self._pending = None
+        self.instruments.last_interlock = self.reading
+        self.checks += 1
+        return interlock_cause(self.reading)
+
+    def trip(self, cause):
+        logging.critical(f'Interlock watchdog triggered: {cause}')
+        self.cause = cause
+        event = InterlockEvent(cause, self.reading.time if self.reading else None, self.clock)
+        self.tripped.set()
+        please_abort.set()
+        pelts_on_off(self.instruments.pelts, False, event, self.instruments.pelt_psu)
+        interlock_latency.record(event)
+
+class TelemetryRecorder(threading.Thread):
+    """Records a full snapshot of the test box every period on its own thread, so the ramps and
+    the interlock are not slowed down by logging. Its reads go through the bus workers, which
+    serialise them with the control loop, and a fresh enough interlock reading taken by the
+    watchdog or the control loop is reused rather than read again.
+    """
+    def __init__(self, instruments, fl, HEADER, write_api, period = TELEMETRY_PERIOD):
+        super().__init__(name='telemetry-recorder', daemon=True)
+        self.instruments = instruments
+        self.fl = fl
+        self.HEADER = HEADER
+        self.write_api = write_api
+        self.period = period
+        self.records = 0
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+    def run(self):
+        tick = ticker('telemetry', self.period, self._stopping, clock_of(self.instruments))
+        while not self._stopping.is_set():
+            try:
+                snapshot = take_snapshot(self.instruments, psus=True, max_age=self.period / 2)
+                log_information(self.fl, self.instruments, self.HEADER, self.write_api, snapshot)
+                self.records += 1
+            except Exception as e:
+                logging.error(f"Error recording telemetry: {e}")
+            tick.wait()
+
 def safe_shutdown(cause, instruments = None):
     print('[SAFE_SHUTDOWN] > please wait patiently...')
     if instruments:
-        with instruments.base: instruments.base.temperature = 20
+        clock = clock_of(instruments)
+        event = InterlockEvent(cause, clock=clock)
+        instruments.huber.setpoint = 20
         for hv in instruments.hvs:
-            if hv.state and hv.voltage > 0.001:
-                hv.sweep(0, step_size=-5)      # Sweep to zero at rate 10V/s 
-            hv.state = False
-        for pelt in instruments.pelt_psu:
-            pelt.current = 0
-            pelt.state = False
+            with throttle(hv):
+                if hv.state and hv.voltage > 0.001:
+                    hv.sweep(0, step_size=-5)      # Sweep to zero at rate 10V/s 
+                hv.state = False
+        for i, pelt in enumerate(instruments.pelt_psu):
+            with throttle(pelt):
+                pelt.current = 0
+                pelt.state = False
+            event.sent[i] = clock.time()
+        for i, pelt in enumerate(instruments.pelt_psu):
+            with throttle(pelt):
+                if not pelt.state:
+                    event.confirmed[i] = clock.time()
+        interlock_latency.record(event)
         print('... this takes a while')
         for lv in instruments.lvs:
-            lv.state = False
+            with throttle(lv):
+                lv.state = False
     show_warning(cause)
 
 def kill_processes():
@@ -280,15 +1482,18 @@ def kill_processes():
 def signal_handler(sig, frame):
     # If we press ctr+c
     print('Ctrl+C received - exiting...')
-    global please_kill
-    if please_kill:
+    if please_kill.is_set():
+        please_abort.set()
         kill_processes()
         safe_shutdown('Keyboard interrupt',  )
         sys.exit(1)
     else:
-        please_kill = True
+        please_kill.set()
 
 def ramp_up(instruments, fl, interlock_condition, HEADER, write_api, mini_ramp_up, temp, max_temp):
+    """Heats the modules to max_temp with the chiller, peltiers off, checking the interlock
+    every CONTROL_PERIOD until the NTCs are within RAMP_TOLERANCE of max_temp.
+    """
     logging.warning('INSIDE RAMP UP')
     cause = ''
     # pelts_on_off(pelts, False)
@@ -297,92 +1502,214 @@ def ramp_up(instruments, fl, interlock_condition, HEADER, write_api, mini_ramp_u
         return interlock_condition, cause
     
     if not mini_ramp_up:
-        with instruments.base: instruments.base.temperature = max_temp + 15 if max_temp < 55 else 70
-        with instruments.base: logging.info(f"Chiller: {instruments.base.temperature}")
+        instruments.huber.setpoint = max_temp + 15 if max_temp < 55 else 70
+        logging.info(f"Chiller: {instruments.huber.setpoint}")
         
-    while temp < max_temp: #Go up
-
-        pelt_temperature_now = avg(instruments.ntcs)
+    # if (max_temp - 12 < temp) or (temp < max_temp - 8):
+        # lvs_on_off(lvs, 1.0, 0.5, True) #Set the low voltage power supplies to 1.0V and 0.5A
+    
+    tick = ticker('ramp up', CONTROL_PERIOD, clock=clock_of(instruments))
+    snapshot = take_snapshot(instruments)
+    pelt_temperature_now = avg(snapshot.ntcs)
+    while pelt_temperature_now < max_temp - RAMP_TOLERANCE: #Go up
+        if please_abort.is_set():
+            interlock_condition, cause = True, 'Aborted'
+            break
+        logging.info(f'Reaching desired temperature {max_temp}')
         
-        # if (max_temp - 12 < temp) or (temp < max_temp - 8):
-            # lvs_on_off(lvs, 1.0, 0.5, True) #Set the low voltage power supplies to 1.0V and 0.5A
-            
-        while pelt_temperature_now < temp - 0.1:
-            logging.info('Reaching desired temperature', temp)            
-            
-            # log_information(fl, ntcs, lvs, pelt_psu, hvs, humi, chuck_temp, HEADER, write_api, temp_85)
-            
-            interlock_condition, cause, mini_ramp_up, temp = interlock_test(instruments, mini_ramp_up, temp)
-            
-            pelt_temperature_now = avg(instruments.ntcs)
-            logging.info(f"Current NTC temp: {pelt_temperature_now}C")
-            if interlock_condition:
-                break
-        temp += 1          
+        interlock_condition, cause, mini_ramp_up, temp = interlock_test(instruments, mini_ramp_up, temp, snapshot)
         if interlock_condition:
             break
+        
+        tick.wait()
+        snapshot = take_snapshot(instruments)
+        pelt_temperature_now = avg(snapshot.ntcs)
+        logging.info(f"Current NTC temp: {pelt_temperature_now}C")
             
-        # lvs_on_off(lvs, 0.0, 0.0, False) #Turn off the low voltage power supplies    
+    # lvs_on_off(lvs, 0.0, 0.0, False) #Turn off the low voltage power supplies    
     logging.warning("RAMP UP FINISHED")            
     return interlock_condition, cause
 
+class SetpointTrajectory:
+    """Continuous setpoint profile from start to target at a maximum rate in °C/min.
+    The setpoint only advances while the measured temperature is within tracking_error of it,
+    so the PIDs are driven as fast as the modules can follow and no faster.
+    """
+    def __init__(self, start, target, rate = None, tracking_error = None, clock = WALL_CLOCK):
+        self.clock = clock
+        self.setpoint = float(start)
+        self.target = float(target)
+        self.rate = abs(rate if rate is not None else RAMP_DOWN_RATE)
+        self.tracking_error = tracking_error if tracking_error is not None else TRACKING_ERROR
+        self._last = clock.monotonic()
+
+    @property
+    def done(self) -> bool:
+        return self.setpoint == self.target
+
+    def reset(self, setpoint):
+        self.setpoint = float(setpoint)
+        self._last = self.clock.monotonic()
+
+    def advance(self, measured, scale = 1.0) -> float:
+        """Moves the setpoint towards the target by rate * scale for the time elapsed since the
+        last call, unless measured lags the setpoint by more than tracking_error.
+        Returns the new setpoint.
+        """
+        now = self.clock.monotonic()
+        dt, self._last = now - self._last, now
+        direction = 1 if self.target > self.setpoint else -1
+        if (self.setpoint - measured) * direction > self.tracking_error:
+            return self.setpoint
+        step = self.rate * scale * dt / 60
+        if abs(self.target - self.setpoint) <= step:
+            self.setpoint = self.target
+        else:
+            self.setpoint += direction * step
+        return self.setpoint
+
+class MarginForecaster:
+    """Forecasts when the dewpoint margin (chuck PT100 - dewpoint, worst module) will fall below
+    MINI_RAMP_MARGIN, from a linear fit over the recent humidity, SHT85 and chuck temperature
+    readings in the telemetry buffer. Lets ramp_down() slow or hold the descent before the
+    margin is violated, instead of paying for a mini ramp up afterwards.
+    """
+    def __init__(self, telemetry, window = FORECAST_WINDOW, threshold = MINI_RAMP_MARGIN):
+        self.telemetry = telemetry
+        self.window = window
+        self.threshold = threshold
+
+    def time_to_violation(self) -> float:
+        """Seconds until the worst margin is forecast to reach the threshold: 0 if it already has,
+        inf if it is not falling or there is not enough history.
+        """
+        if self.telemetry is None:
+            return math.inf
+        rows = self.telemetry.since(self.window)
+        if len(rows) < 3:
+            return math.inf
+        margin = dewpoint_margin(rows['humi'], rows['temp_85'], rows['pt100'])[1].min(axis=1)
+        t = (rows['time'] - rows['time'][-1]) / 1e9
+        slope = np.polyfit(t, margin, 1)[0]
+        if margin[-1] <= self.threshold:
+            return 0.0
+        if slope >= 0:
+            return math.inf
+        return (margin[-1] - self.threshold) / -slope
+
+def precool(instruments : Instruments, target, timeout, temp) -> tuple:
+    """Waits for the chiller to pre-cool the chucks before the peltiers are switched on: until the
+    chuck PT100s are within PRECOOL_MARGIN of target, or, once they have cooled by PRECOOL_MARGIN,
+    their temperature has flattened out to less than PRECOOL_FLAT_RATE over PRECOOL_WINDOW,
+    or timeout seconds have passed. The rate is measured on the telemetry buffer.
+    The interlock is checked every CONTROL_PERIOD throughout.
+    Returns:
+        A tuple (interlock_condition, cause).
+    """
+    clock = clock_of(instruments)
+    start = clock.monotonic()
+    start_temp = None
+    telemetry = getattr(instruments, 'telemetry', None)
+    tick = ticker('pre-cool', CONTROL_PERIOD, clock=clock)
+    while clock.monotonic() - start < timeout:
+        if please_abort.is_set():
+            return True, 'Aborted'
+        snapshot = take_snapshot(instruments)
+        interlock_condition, cause, _, _ = interlock_test(instruments, True, temp, snapshot)  # peltiers are off, no mini ramp up
+        if interlock_condition:
+            return interlock_condition, cause
+        
+        now = clock.monotonic()
+        chuck_temp = avg(snapshot.chuck_temp)
+        if start_temp is None:
+            start_temp = chuck_temp
+        if chuck_temp <= target + PRECOOL_MARGIN:
+            logging.warning(f"Pre-cool done after {(now - start) / 60:.1f} min: chuck at {chuck_temp:.1f}°C")
+            return False, ''
+        if start_temp - chuck_temp >= PRECOOL_MARGIN and now - start >= PRECOOL_WINDOW and telemetry is not None:
+            rate = np.mean(telemetry.rate('pt100', PRECOOL_WINDOW))
+            if abs(rate) < PRECOOL_FLAT_RATE:
+                logging.warning(f"Pre-cool done after {(now - start) / 60:.1f} min: chuck flat at {chuck_temp:.1f}°C ({rate:.2f}°C/min)")
+                return False, ''
+        tick.wait()
+    logging.warning(f"Pre-cool timed out after {timeout / 60:.0f} min")
+    return False, ''
+
 def ramp_down(instruments : Instruments, fl, interlock_condition, HEADER, write_api, temp, mini_ramp_up, min_temp):
+    """Cools the modules from temp to min_temp by driving the PID setpoints along a
+    SetpointTrajectory, checking the interlock every CONTROL_PERIOD, until the NTCs are
+    within RAMP_TOLERANCE of min_temp.
+    """
     logging.warning('INSIDE RAMP DOWN')
     
     cause = ''
   
-    with instruments.base: instruments.base.temperature = min_temp
-    with instruments.base: logging.info(f"Chiller: {instruments.base.temperature}")
-    pelt_temperature_now = avg(instruments.ntcs)
+    instruments.huber.setpoint = min_temp
+    logging.info(f"Chiller: {instruments.huber.setpoint}")
+    pelt_temperature_now = avg(take_snapshot(instruments).ntcs)
     
     if min_temp < -40:
-        logging.warning("45 minute pause to allow chiller to begin cooling")
-        time.sleep(45*60)
+        logging.warning("Up to 45 minute pause to allow chiller to begin cooling")
+        interlock_condition, cause = precool(instruments, min_temp, 45*60, temp)
     elif pelt_temperature_now - min_temp > 10:
-        logging.warning("Seven minute pause to allow chiller to begin cooling")
-        time.sleep(7*60)
+        logging.warning("Up to seven minute pause to allow chiller to begin cooling")
+        interlock_condition, cause = precool(instruments, min_temp, 7*60, temp)
+    
+    if interlock_condition:
+        return interlock_condition, cause
     
     pelts_on_off(instruments.pelts, True)
+    forecaster = MarginForecaster(getattr(instruments, 'telemetry', None))
+    trajectory = SetpointTrajectory(temp, min_temp, clock=clock_of(instruments))
+    commanded = None
+    tick = ticker('ramp down', CONTROL_PERIOD, clock=clock_of(instruments))
+    while True: #Go down
+        if please_abort.is_set():
+            interlock_condition, cause = True, 'Aborted'
+            break
         
-    while temp > min_temp: #Go down
-            
-            for i, pelt in enumerate(instruments.pelts):
-                logging.info(f"Ramp down: Setting pelt{i} temperature to {temp}")
-                time.sleep(LONG_DELAY)
-                pelt.temperature = temp
-            
-            pelt_temperature_now = avg(instruments.ntcs)
+        snapshot = take_snapshot(instruments)
+        pelt_temperature_now = avg(snapshot.ntcs)
+        logging.info(f"Current NTC temp: {pelt_temperature_now}C, setpoint {trajectory.setpoint:.1f}C")
+        if trajectory.done and pelt_temperature_now <= min_temp + RAMP_TOLERANCE:
+            break
+        
+        interlock_condition, cause, mini_ramp_up, temp = interlock_test(instruments, mini_ramp_up, trajectory.setpoint, snapshot)
+        
+        if mini_ramp_up:
+            logging.warning(f'INSIDE MINI RAMP UP TEMP {temp}')
+            pelts_on_off(instruments.pelts,False)
             
-            while pelt_temperature_now > temp + 0.5:
-                logging.info('Reaching desired temperature', temp)            
-                logging.info(f"Current NTC temp: {pelt_temperature_now}C")
-                
-                # log_information(fl, ntcs, lvs, pelt_psu, hvs, humi, chuck_temp, HEADER, write_api, temp_85)
-                
-                interlock_condition, cause, mini_ramp_up, temp = interlock_test(instruments, mini_ramp_up, temp)
-                
-                if mini_ramp_up:
-                    logging.warning('INSIDE MINI RAMP UP TEMP', temp)
-                    pelts_on_off(instruments.pelts,False)
-                    
-                    interlock_condition, cause = ramp_up(instruments, fl, interlock_condition, HEADER,write_api, mini_ramp_up, temp - 5,  temp) #Last temp is the new target temperature (increased by 5 through the mini ramp up condition and set to level in the temp - 5)
-                    mini_ramp_up = False
-
-                    pelts_on_off(instruments.pelts, True)
-
-                pelt_temperature_now = avg(instruments.ntcs)
-                if interlock_condition:
-                    logging.critical("INTERLOCK CONDITION IN LOOP")
-                    break 
-                
-            if (temp - min_temp) > 5:
-                temp -= 5
-            else:
-                temp -= 1
-                        
-            if interlock_condition:
-                logging.critical("INTERLOCK CONDITION OUT OF LOOP")
-                break
+            interlock_condition, cause = ramp_up(instruments, fl, interlock_condition, HEADER,write_api, mini_ramp_up, temp - 5,  temp) #Last temp is the new target temperature (increased by 5 through the mini ramp up condition and set to level in the temp - 5)
+            mini_ramp_up = False
+            trajectory.reset(temp)
+
+            pelts_on_off(instruments.pelts, True)
+            tick.restart()
+
+        if interlock_condition:
+            logging.critical("INTERLOCK CONDITION IN LOOP")
+            break 
+        
+        eta = forecaster.time_to_violation()
+        if eta < FORECAST_HORIZON / 2:
+            logging.warning(f"Dewpoint margin forecast below {MINI_RAMP_MARGIN}°C in {eta:.0f}s, holding at {trajectory.setpoint:.1f}°C")
+            scale = 0.0
+        elif eta < FORECAST_HORIZON:
+            logging.warning(f"Dewpoint margin forecast below {MINI_RAMP_MARGIN}°C in {eta:.0f}s, slowing down")
+            scale = FORECAST_SLOWDOWN
+        else:
+            scale = 1.0
+        setpoint = round(trajectory.advance(pelt_temperature_now, scale), 1)
+        
+        if setpoint != commanded:
+            logging.info(f"Ramp down: Setting pelts temperature to {setpoint}")
+            for r in pelts_set_temperature(instruments.pelts, setpoint):
+                if not r.ok:
+                    logging.error(f"Ramp down: failed to set pelt{r.index} temperature: {r.error}")
+            commanded = setpoint
+        
+        tick.wait()
     logging.warning("RAMP DOWN FINISHED")
     
     pelts_on_off(instruments.pelts, False)
@@ -398,6 +1725,46 @@ def setup_logging(verbosity):
     logging.getLogger().setLevel(level)
     logging.info(f"Verbosity level set to {logging.getLogger().level}")
     
+def open_channels(inst_modules : list, resources = RESOURCES, backend = None) -> dict:
+    """Creates the instruments of the test box and the channels tacc uses, for the given modules.
+    Args:
+        inst_modules: module numbers, 1 to 4
+        resources: instrument resources, as in RESOURCES
+        backend: provides the instrument classes and open_tricicles(); the icicle classes and
+            pidcontroller-ui processes if None, or a tacc_sim.SimBackend to simulate the box
+    Returns:
+        A dict of the channels, keyed by their Instruments attribute names.
+    """
+    if backend is None:
+        backend = Instruments(ITkDCSInterlock=ITkDCSInterlock, HMP4040=HMP4040, Keithley2410=Keithley2410,
+                              HuberCC508=hubercc508.HuberCC508, PIDController=PIDController, open_tricicles=open_tricicles)
+    channels = {}
+    interlock = backend.ITkDCSInterlock(resource=resources['interlock'])
+    channels['ntcs'] = [interlock.channel("MeasureChannel", channel, measure_type='NTC:TEMP') for channel in inst_modules]
+    channels['ilock_relay'] = [interlock.channel("MeasureChannel", channel, measure_type='RELAY:STATUS') for channel in inst_modules]
+    channels['chuck_temp'] = [interlock.channel("MeasureChannel", channel, measure_type='PT100:TEMP') for channel in inst_modules] #Temperature of the module chuck
+    channels['humi'] = interlock.channel("MeasureChannel", 1, measure_type='SHT85:HUMI')
+    channels['temp_85'] = interlock.channel("MeasureChannel", 1, measure_type='SHT85:TEMP') #Temperature of the peltier back
+    channels['lid'] = interlock.channel("MeasureChannel", 1, measure_type='LID:VOLT')
+    lv_psu = backend.HMP4040(resource=resources['lv_psu'])
+    channels['lvs'] = [lv_psu.channel("PowerChannel", channel) for channel in inst_modules]
+    peltier_psu = backend.HMP4040(resource=resources['pelt_psu'])
+    channels['pelt_psu'] = [peltier_psu.channel("PowerChannel", channel) for channel in inst_modules]
+    hv_psu = backend.Keithley2410(resource=resources['hv_psu'])
+    channels['hvs'] = [hv_psu.channel("PowerChannel", 1)]
+    h = backend.HuberCC508(resource=resources['huber'])
+    channels['base'] = h.channel("TemperatureChannel", 1)
+    channels['chiller'] = h.channel("TemperatureChannel", 1)
+
+    # These config files should only contain 1 channel each.
+    port0 = resources['pid_port0']
+    backend.open_tricicles(inst_modules, port0, resources['pid_config'])
+    channels['pelts'] = []
+    for i in inst_modules:
+        p = backend.PIDController(resource = f"TCPIP::localhost::{port0+i}::SOCKET")
+        channels['pelts'].append(p.channel("TemperatureChannel", 1)) # must assign channel 1 (maybe?)
+    return channels
+
 @click.command()
 @click.argument(
     'modules', 
@@ -423,6 +1790,103 @@ def setup_logging(verbosity):
     show_default=True,
     help='Temperature range'
 )
+@click.option(
+    '--console',
+    is_flag=True,
+    help='Read operator commands from stdin while the cycle runs: status, stop (after the current cycle) or abort'
+)
+@click.option(
+    '-c',
+    '--control-period',
+    metavar='<seconds>',
+    type=float,
+    default=CONTROL_PERIOD,
+    show_default=True,
+    help='Period of the control ticks of the ramps, each of which reads the box once'
+)
+@click.option(
+    '-r',
+    '--ramp-rate',
+    metavar='<°C/min>',
+    type=float,
+    default=RAMP_DOWN_RATE,
+    show_default=True,
+    help='Maximum rate of the peltier setpoints while ramping down'
+)
+@click.option(
+    '--tracking-error',
+    metavar='<°C>',
+    type=float,
+    default=TRACKING_ERROR,
+    show_default=True,
+    help='How far the NTCs may lag the setpoint before it stops advancing'
+)
+@click.option(
+    '-w',
+    '--watchdog-period',
+    metavar='<seconds>',
+    type=float,
+    default=WATCHDOG_PERIOD,
+    show_default=True,
+    help='Period of the interlock watchdog checks'
+)
+@click.option(
+    '-l',
+    '--log-period',
+    metavar='<seconds>',
+    type=float,
+    default=TELEMETRY_PERIOD,
+    show_default=True,
+    help='Period of the telemetry records'
+)
+@click.option(
+    '-g',
+    '--command-gap',
+    metavar='<instrument=seconds>',
+    multiple=True,
+    help=f'Minimum gap between commands to the same instrument, can be repeated. Instruments: {", ".join(COMMAND_GAPS)}'
+)
+@click.option(
+    '--to-csv',
+    'to_csv',
+    metavar='<run log>',
+    type=click.Path(exists=True, file_okay=False),
+    help='Convert a run log directory to CSV and exit'
+)
+@click.option(
+    '--simulate',
+    is_flag=True,
+    help='Run against the simulated test box in tacc_sim.py instead of the hardware'
+)
+@click.option(
+    '--sim-speed',
+    metavar='<factor>',
+    type=float,
+    default=1.0,
+    show_default=True,
+    help='With --simulate: how many times faster than real time the simulation runs'
+)
+@click.option(
+    '--sim-noise',
+    metavar='<°C>',
+    type=float,
+    default=tacc_sim.SENSOR_NOISE,
+    show_default=True,
+    help='With --simulate: standard deviation of the simulated temperature and humidity readings'
+)
+@click.option(
+    '--sim-latency',
+    metavar='<seconds>',
+    type=float,
+    default=tacc_sim.BUS_LATENCY,
+    show_default=True,
+    help='With --simulate: time each simulated instrument transaction takes'
+)
+@click.option(
+    '--profile',
+    is_flag=True,
+    help='Profile every instrument read, write and command; the summary is printed at the end, or on SIGUSR1'
+)
 @click.option(
     '-v', '--verbosity',
     count=True, 
@@ -430,7 +1894,7 @@ def setup_logging(verbosity):
     show_default=True,
     help='Increase output verbosity: -v, -vv, -vvv'
 )
-def cli(n_cycles, temp_range, modules, verbosity):
+def cli(n_cycles, temp_range, modules, console, control_period, ramp_rate, tracking_error, watchdog_period, log_period, command_gap, to_csv, simulate, sim_speed, sim_noise, sim_latency, profile, verbosity):
     """
     TaCC (ThermAl Cycle Control)
     
@@ -439,11 +1903,16 @@ def cli(n_cycles, temp_range, modules, verbosity):
     python tacc \n # Does 10 thermal cycles of all modules between -40 and 45 \n
     python tacc 1 2 3 4 -n 1 -t -55 60 && python tacc 1 2 3 4 \n # Does 1 big + 10 small
     """
+    if to_csv:
+        click.echo(f"Written {runlog_to_csv(to_csv)}")
+        return
+    
     min_temp, max_temp = temp_range
     click.echo(f"n_cycles: {n_cycles}")
     click.echo(f"min_temp: {min_temp}")
     click.echo(f"max_temp: {max_temp}")
     click.echo(f"modules: {modules}")
+    click.echo(f"console: {console}")
     click.echo(f"verbosity: {verbosity}")
     
     
@@ -452,46 +1921,75 @@ def cli(n_cycles, temp_range, modules, verbosity):
     elif not any([a in [1,2,3,4] for a in modules]):
         raise click.BadParameter("Invalid module numbers, should be subset of {1,2,3,4}")
     inst_modules = [m for m in modules]
+    
+    global RAMP_DOWN_RATE, TRACKING_ERROR, CONTROL_PERIOD
+    RAMP_DOWN_RATE, TRACKING_ERROR, CONTROL_PERIOD = ramp_rate, tracking_error, control_period
+    
+    for item in command_gap:
+        name, _, gap = item.partition('=')
+        if name not in COMMAND_GAPS:
+            raise click.BadParameter(f"Unknown instrument {name!r}, should be one of {', '.join(COMMAND_GAPS)}")
+        COMMAND_GAPS[name] = float(gap)
         
     setup_logging(verbosity)
     
     signal.signal(signal.SIGINT, signal_handler)
+    if profile:
+        signal.signal(signal.SIGUSR1, profile_handler)
     
-    # interlock variables
-    interlock = ITkDCSInterlock(resource='TCPIP::localhost::9898::SOCKET')
-    ntcs = [interlock.channel("MeasureChannel", channel, measure_type='NTC:TEMP') for channel in inst_modules]
-    ilock_relay = [interlock.channel("MeasureChannel", channel, measure_type='RELAY:STATUS') for channel in inst_modules]
-    chuck_temp = [interlock.channel("MeasureChannel", channel, measure_type='PT100:TEMP') for channel in inst_modules] #Temperature of the module chuck
-    humi = interlock.channel("MeasureChannel", 1, measure_type='SHT85:HUMI')
-    temp_85 = interlock.channel("MeasureChannel", 1, measure_type='SHT85:TEMP') #Temperature of the peltier back
-    lid = interlock.channel("MeasureChannel", 1, measure_type='LID:VOLT')
-    lv_psu = HMP4040(resource='ASRL/dev/ttyHMP4040a::INSTR')
-    lvs = [lv_psu.channel("PowerChannel", channel) for channel in inst_modules]
-    peltier_psu = HMP4040(resource='ASRL/dev/ttyHMP4040b::INSTR')
-    pelt_psu = [peltier_psu.channel("PowerChannel", channel) for channel in inst_modules]
-    hv_psu = Keithley2410(resource='ASRL/dev/ttyUSB0::INSTR')
-    #hv_psu = Keithley2410(resource='ASRL/dev/ttyHMP4040b::INSTR') #PLACEHOLDER FOR WHEN THE HV ISN'T ATTACHED, REMOVE!!!!
-    hvs = [hv_psu.channel("PowerChannel", 1)]
-    h = hubercc508.HuberCC508(resource = '/dev/ttyACM0')
-    base = h.channel("TemperatureChannel", 1)
-    chiller = h.channel("TemperatureChannel", 1)
-
-    pelts = []
-    port0 = 19895
-    
-    for i in inst_modules:
-        # These config files should only contain 1 channel each.
-        
-        tricicle = open_tricicle(f"./pidcontroller_j{i}.toml", port=port0+i) 
-        time.sleep(2)
-        processes.append(tricicle)
-        p = PIDController(resource = f"TCPIP::localhost::{port0+i}::SOCKET")
-        pelts.append(p.channel("TemperatureChannel", 1)) # must assign channel 1 (maybe?)
+    backend = None
+    if simulate:
+        backend = tacc_sim.SimBackend(RESOURCES, speed=sim_speed, noise=sim_noise, latency=sim_latency)
+        click.echo(f"Simulating the test box at {sim_speed:g}x")
+    run_test_box(inst_modules, n_cycles, min_temp, max_temp, RESOURCES, backend, console, watchdog_period, log_period,
+                 endpoint=None if simulate else ENDPOINT, profile=profile)
+
+def run_test_box(inst_modules : list, n_cycles, min_temp, max_temp, resources = RESOURCES, backend = None, console = False,
+                 watchdog_period = WATCHDOG_PERIOD, log_period = TELEMETRY_PERIOD, endpoint = ENDPOINT, log_dir = '.', state = None,
+                 profile = False):
+    """Opens the instruments of one test box, runs the thermal cycle on them with
+    main_with_instruments() and closes them again.
+    Args:
+        resources, backend: as for open_channels(); a backend with a clock (tacc_sim.SimBackend)
+            also provides the run clock, as instruments.clock
+        console: run the cycle under the operator console of run_console()
+        profile: profile the instrument traffic in bus_profiler, and log its summary at the end
+    Returns:
+        What main_with_instruments() returns.
+    """
+    global bus_profiler
+    clock = getattr(backend, 'clock', None) or WALL_CLOCK
+    channels = open_channels(inst_modules, resources, backend)
+    bus_profiler = BusProfiler(clock) if profile else None
+    if bus_profiler is not None:
+        channels = profile_channels(channels, inst_modules, bus_profiler)
+    ntcs, ilock_relay, chuck_temp = channels['ntcs'], channels['ilock_relay'], channels['chuck_temp']
+    humi, temp_85, lid = channels['humi'], channels['temp_85'], channels['lid']
+    lvs, pelt_psu, hvs = channels['lvs'], channels['pelt_psu'], channels['hvs']
+    base, chiller, pelts = channels['base'], channels['chiller'], channels['pelts']
 
     global MODULES
     MODULES = [x-1 for x in inst_modules]
     
+    limiters = {
+        'interlock': register_limiter([*ntcs, *ilock_relay, *chuck_temp, humi, temp_85, lid], 'interlock', clock),
+        'lv_psu': register_limiter(lvs, 'lv_psu', clock),
+        'pelt_psu': register_limiter(pelt_psu, 'pelt_psu', clock),
+        'hv_psu': register_limiter(hvs, 'hv_psu', clock),
+        'huber': register_limiter([base, chiller], 'huber', clock),
+    }
+    for pelt in pelts:
+        register_limiter([pelt], 'pid', clock)   # each PID controller listens on its own port
+    
+    buses = make_buses(limiters)
+    pid_sessions = PIDSessions(pelts, clock=clock)
+    huber = Chiller(base, buses['huber'], clock=clock)
     instruments = Instruments(
+        clock=clock,
+        telemetry=TelemetryBuffer(len(inst_modules)),
+        huber=huber,
+        pid_sessions=pid_sessions,
+        buses=buses,
         ntcs=ntcs,
         chuck_temp=chuck_temp,
         humi=humi,
@@ -506,73 +2004,230 @@ def cli(n_cycles, temp_range, modules, verbosity):
         ilock_relay=ilock_relay
     )
     
-    for ch in [*ntcs, *lvs, *pelt_psu ,*hvs, humi, *chuck_temp, *ilock_relay]:
+    for ch in [*ntcs, *lvs, *pelt_psu ,*hvs, humi, temp_85, lid, *chuck_temp, *ilock_relay]:
         ch.__enter__()
     try:
+        huber.open()
+        pid_sessions.open()
         
-        main_with_instruments(instruments, n_cycles, min_temp, max_temp)
+        return main_with_instruments(instruments, n_cycles, min_temp, max_temp, console, watchdog_period, log_period,
+                                     endpoint, log_dir, state)
     finally:
         instruments = {}
-        for ch in [*ntcs, *lvs, *pelt_psu, *hvs, humi, *chuck_temp, *ilock_relay]:
+        pid_sessions.close()
+        huber.close()
+        for bus in buses.values():
+            bus.shutdown()
+        for ch in [*ntcs, *lvs, *pelt_psu, *hvs, humi, temp_85, lid, *chuck_temp, *ilock_relay]:
             ch.__exit__(None, None, None)
         kill_processes()
+        if bus_profiler is not None:
+            logging.warning(bus_profiler.summary())
 
-def main_with_instruments(instruments : Instruments, n_cycles, min_temp, max_temp):
-
-    write_api = None
-    
-    write_api = connect_to_db(ENDPOINT)
-    if write_api is None:
-        print('[ERROR]: Cannot connect to database. Refusing to run.')
-        sys.exit(1)
-
+def main_with_instruments(instruments : Instruments, n_cycles, min_temp, max_temp, console = False, watchdog_period = WATCHDOG_PERIOD, log_period = TELEMETRY_PERIOD, endpoint = ENDPOINT, log_dir = '.', state = None):
+    """Runs the thermal cycle on open instruments, with the interlock watchdog and telemetry
+    recorder alongside, logging to a new run log in log_dir.
+    Args:
+        state: CycleState to record progress and phases in, if any
+    Returns:
+        A tuple (interlock_condition, cause, run log path).
+    """
+    if state is None:
+        state = CycleState()
+    state.clock = clock_of(instruments)
+    state.telemetry = getattr(instruments, 'telemetry', None)
 
     #Log output 
     logfile_time=time.strftime('%Y%m%d_%H%M%S')
-    file_path = logfile_time + '_Interlock_log.csv'
-    
-    with open(file_path,'a') as fl: #FOLLOW EXAMPLE IN MAIN, NEED TO WRAP AROUND POLL PROCESS AND WRITE LINE BY LINE
-        HEADER = ['time', 'NTC', 'HUMI', 'TEMP', 'DEWPOINT', 'LV VOLT', 'LV CURR', 'PELT VOLT', 'PELT CURR', 'HV VOLT', 'HV CURR']
-        fl.write(', '.join(HEADER) + '\n')
-        interlock_condition = False
-        mini_ramp_up = False
+    write_api = connect_to_db(endpoint, os.path.join(log_dir, logfile_time + '_influx_spool.lp'), state.clock)
 
-        global please_kill
-        cycles = 0
+    file_path = os.path.join(log_dir, logfile_time + '_Interlock_log')
+    HEADER = build_header([m + 1 for m in MODULES])
+    columns = [('time', np.int64, ())] + [(name, np.float64, ()) for name in HEADER[1:]]
+    
+    with ColumnarLog(file_path, columns, clock=state.clock) as fl:
 
-        with instruments.base: instruments.base.speed = 2000
-        with instruments.base: instruments.base.state = True
-        
-        # print(f"Peltiers initial states: {pelts_read(pelts)!r}")
-        temp = 20
-        logging.warning(f"Doing {n_cycles} cycles from {min_temp}°C to {max_temp}°C with modules {MODULES}")  
-        while not please_kill and cycles < n_cycles:
-            cycles += 1
-            logging.warning(f"\n*********Cycle {cycles}*********\n")
-            with ExitStack() as stack:
-                stack = [stack.enter_context(pelt) for pelt in instruments.pelts]
-                
-                interlock_condition, cause = ramp_down(instruments, fl, interlock_condition, HEADER, write_api, temp, mini_ramp_up, min_temp)
-                
-                temp = min_temp
-                interlock_condition, cause = ramp_up(instruments, fl, interlock_condition, HEADER, write_api, mini_ramp_up, temp, max_temp)
-                
-                temp = max_temp            
-                if interlock_condition:
-                    break
-                
-                if cycles == n_cycles:
-                    interlock_condition, cause = ramp_down(instruments, fl, interlock_condition, HEADER, write_api, temp, mini_ramp_up, 20)
-                    with instruments.base: instruments.base.state = False
-                    # lvs_on_off(lv, 0,0, False)
-        
+        watchdog = InterlockWatchdog(instruments, period=watchdog_period)
+        watchdog.start()
+        recorder = TelemetryRecorder(instruments, fl, HEADER, write_api, period=log_period)
+        recorder.start()
+        try:
+            if console:
+                interlock_condition, cause = asyncio.run(run_console(instruments, fl, HEADER, write_api, n_cycles, min_temp, max_temp, watchdog, state))
+            else:
+                interlock_condition, cause = run_cycles(instruments, fl, HEADER, write_api, n_cycles, min_temp, max_temp, state)
+        finally:
+            recorder.stop()
+            watchdog.stop()
+            state.watchdog_checks = watchdog.checks
+            write_api.close()
+            if interlock_latency.histograms:
+                logging.warning("Interlock reaction latencies:\n" + interlock_latency.summary())
+            if tickers:
+                logging.warning("Tick schedule:\n" + '\n'.join(f"  {name}: {t.summary()}" for name, t in tickers.items()))
+        if watchdog.cause:
+            interlock_condition, cause = True, watchdog.cause
         
         if interlock_condition:
-            with instruments.base: instruments.base.state = True
-            with instruments.base: instruments.base.temperature = 20
+            instruments.huber.state = True
+            instruments.huber.setpoint = 20
             # for i in range(3):
                 # instruments.lvs[i].state = False
                 # hvs[i].state = False
+    return interlock_condition, cause, file_path
+
+@dataclass
+class PhaseRecord:
+    """One ramp of the cycle sequence: its target, start and end times, and the instrument
+    transaction totals at its start and end if the CycleState has counters.
+    """
+    cycle: int
+    phase: str
+    target: float
+    start: float
+    end: float = None
+    start_counts: dict = None
+    end_counts: dict = None
+
+class CycleState:
+    """Progress of the thermal cycle, shared between the cycle sequence and its monitors."""
+    def __init__(self):
+        self.phase = 'idle'
+        self.cycle = 0
+        self.cause = ''
+        self.phases = []            # PhaseRecord of every ramp so far
+        self.watchdog_checks = 0
+        self.telemetry = None       # TelemetryBuffer of the run, for monitors
+        self.clock = WALL_CLOCK     # run clock the phases are timed on
+        self.counters = None        # callable returning running transaction totals, e.g. tacc_sim.SimBackend.transaction_totals
+
+    def enter(self, phase, target = None):
+        """Moves on to phase, ending the PhaseRecord of the current one. Phases with a target are recorded."""
+        now = self.clock.time()
+        counts = self.counters() if self.counters is not None else None
+        if self.phases and self.phases[-1].end is None:
+            self.phases[-1].end = now
+            self.phases[-1].end_counts = counts
+        self.phase = phase
+        if target is not None:
+            self.phases.append(PhaseRecord(self.cycle, phase, target, now, start_counts=counts))
+
+def run_cycles(instruments : Instruments, fl, HEADER, write_api, n_cycles, min_temp, max_temp, state = None):
+    """Runs the thermal cycle sequence: n_cycles of ramp down to min_temp and up to max_temp,
+    followed by a final ramp down to 20°C.
+    Args:
+        state: CycleState to report progress to, if any
+    Returns:
+        A tuple (interlock_condition, cause).
+    """
+    if state is None:
+        state = CycleState()
+    interlock_condition = False
+    cause = ''
+    mini_ramp_up = False
+
+    instruments.huber.speed = 2000
+    instruments.huber.state = True
+    
+    # print(f"Peltiers initial states: {pelts_read(pelts)!r}")
+    temp = 20
+    logging.warning(f"Doing {n_cycles} cycles from {min_temp}°C to {max_temp}°C with modules {MODULES}")  
+    while not please_kill.is_set() and not please_abort.is_set() and state.cycle < n_cycles:
+        state.cycle += 1
+        logging.warning(f"\n*********Cycle {state.cycle}*********\n")
+        instruments.pid_sessions.check()
+        
+        state.enter('ramp down', min_temp)
+        interlock_condition, cause = ramp_down(instruments, fl, interlock_condition, HEADER, write_api, temp, mini_ramp_up, min_temp)
+        
+        temp = min_temp
+        state.enter('ramp up', max_temp)
+        interlock_condition, cause = ramp_up(instruments, fl, interlock_condition, HEADER, write_api, mini_ramp_up, temp, max_temp)
+        
+        temp = max_temp            
+        if interlock_condition:
+            break
+        
+        if state.cycle == n_cycles:
+            state.enter('final ramp down', 20)
+            interlock_condition, cause = ramp_down(instruments, fl, interlock_condition, HEADER, write_api, temp, mini_ramp_up, 20)
+            instruments.huber.state = False
+            # lvs_on_off(lv, 0,0, False)
+    state.enter('done')
+    return interlock_condition, cause
+
+
+async def operator_task(state : CycleState, watchdog : InterlockWatchdog):
+    """Reads operator commands from stdin: 'status', 'stop' (after this cycle) and 'abort'."""
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue()
+    try:
+        loop.add_reader(sys.stdin, lambda: lines.put_nowait(sys.stdin.readline()))
+    except (ValueError, OSError, NotImplementedError) as e:
+        logging.info(f"Operator commands unavailable: {e}")
+        return
+    try:
+        while True:
+            line = await lines.get()
+            if not line:
+                return  # stdin closed
+            command = line.strip().lower()
+            if command == 'status':
+                ntc = f"{avg(watchdog.reading.ntcs):.2f}°C" if watchdog.reading else 'n/a'
+                print(f"Cycle {state.cycle}, {state.phase}, NTCs {ntc}, interlock checks {watchdog.checks}")
+            elif command == 'stop':
+                logging.warning('Stopping after the current cycle')
+                please_kill.set()
+            elif command == 'abort':
+                logging.warning('Aborting the current cycle')
+                state.cause = 'Operator abort'
+                please_abort.set()
+            elif command:
+                print(f"Unknown command {command!r}, expected status, stop or abort")
+    finally:
+        loop.remove_reader(sys.stdin)
+
+def console_interrupt(state : CycleState):
+    # Ctrl+C under the operator console: first finish the cycle, then abort it
+    print('Ctrl+C received - exiting...')
+    if please_kill.is_set():
+        state.cause = 'Keyboard interrupt'
+        please_abort.set()
+    else:
+        please_kill.set()
+
+async def run_console(instruments : Instruments, fl, HEADER, write_api, n_cycles, min_temp, max_temp, watchdog, state = None):
+    """Operator console around the thermal cycle.
+    The blocking run_cycles() sequence runs in a worker thread, unchanged, while the event
+    loop reads operator commands from stdin and handles Ctrl+C. The ramps are not asyncio
+    tasks: the interlock and telemetry run on their own threads as without the console.
+    Cancellation goes through please_kill (stop after the cycle) and please_abort (stop now).
+    Returns:
+        A tuple (interlock_condition, cause).
+    """
+    loop = asyncio.get_running_loop()
+    if state is None:
+        state = CycleState()
+    loop.add_signal_handler(signal.SIGINT, console_interrupt, state)
+    cycle = asyncio.create_task(asyncio.to_thread(run_cycles, instruments, fl, HEADER, write_api, n_cycles, min_temp, max_temp, state))
+    monitors = [
+        asyncio.create_task(operator_task(state, watchdog)),
+    ]
+    try:
+        interlock_condition, cause = await cycle
+    except asyncio.CancelledError:
+        please_abort.set()
+        raise
+    finally:
+        for task in monitors:
+            task.cancel()
+        await asyncio.gather(*monitors, return_exceptions=True)
+        loop.remove_signal_handler(signal.SIGINT)
+    if state.cause:
+        interlock_condition, cause = True, state.cause
+    if cause == 'Keyboard interrupt':
+        safe_shutdown(cause, instruments)
+    return interlock_condition, cause
 
 def show_warning(cause):
     msg = QMessageBox()
@@ -586,6 +2241,55 @@ def open_tricicle(config_file, port = 19898):
     print(shutil.which("pidcontroller-ui"))
     return subprocess.Popen([shutil.which("pidcontroller-ui"), "-c", config_file, "-a", '-p', str(port)], stdin=None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
+TRICICLE_TIMEOUT = 30.0    # seconds for a pidcontroller-ui instance to start listening
+
+def wait_for_port(port, host = 'localhost', timeout = TRICICLE_TIMEOUT, popen = None):
+    """Probes a TCP port until it accepts a connection.
+    Raises:
+        RuntimeError if popen exits before the port is open, TimeoutError if it does not open in time.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            pass
+        if popen is not None and not poll_process(popen):
+            raise RuntimeError(f"process exited with code {popen.returncode}")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"not listening after {timeout}s")
+        time.sleep(0.1)
+
+def open_tricicles(modules : list, port0 : int, config = RESOURCES['pid_config']) -> dict:
+    """Starts one pidcontroller-ui per module at once, on port port0 + module, and waits
+    until every one of them accepts connections.
+    Args:
+        config: path of the config file of each module, with {module} for the module number
+    Returns:
+        A dict of module number to process.
+    Raises:
+        click.ClickException naming every module that failed to start, after killing all of them.
+    """
+    procs = {}
+    for i in modules:
+        procs[i] = open_tricicle(config.format(module=i), port=port0+i)
+        processes.append(procs[i])
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(procs) or 1) as executor:
+        futures = {i: executor.submit(wait_for_port, port0+i, popen=proc) for i, proc in procs.items()}
+        for i, future in futures.items():
+            try:
+                future.result()
+                logging.info(f"Module {i}: pidcontroller-ui listening on port {port0+i}")
+            except Exception as e:
+                logging.critical(f"Module {i}: pidcontroller-ui on port {port0+i} failed to start: {e}")
+                errors.append(f"module {i} (port {port0+i}): {e}")
+    if errors:
+        kill_processes()
+        raise click.ClickException("PID controllers failed to start: " + '; '.join(errors))
+    return procs
+
 def kill_process(popen):
     popen.kill()
 
@@ -600,19 +2304,133 @@ def connect_db(url,
                org=''):
     client = InfluxDBClient(url=url, token='')
     write_api = client.write_api(write_options=SYNCHRONOUS)
-    if client.ping():
-        return write_api
-    else:
-        return False
+    try:
+        if client.ping():
+            return write_api
+    except Exception as e:
+        logging.debug(f"Database ping failed: {e}")
+    return False
 
-def connect_to_db(endpoint):
-    write_api = connect_db(endpoint)
-    if write_api:
-        print('\nConnected to instruments.database, logging locally, and to influxDB if switched on!\n')
-        return write_api
-    else:
-        print('\nCould not connect to instruments.database, only logging locally!\n')
-        return None
+INFLUX_BATCH_SIZE = 500        # points per write to the database
+INFLUX_FLUSH_INTERVAL = 5.0    # seconds a point may wait for its batch to fill up
+INFLUX_MAX_BACKOFF = 300.0     # longest wait in seconds between reconnection attempts
+
+class InfluxWriter(threading.Thread):
+    """Writes points to InfluxDB from a background thread, in batches, so the control loop
+    never waits on the database. While the database is unreachable the batches are appended
+    to a local spool file of line protocol, and reconnection is retried with exponential
+    backoff. Once the database is back the spool is replayed, then truncated.
+    write() has the signature of the influxdb_client write API, so it is a drop-in for it.
+    """
+    def __init__(self, url, spool_path, bucket = 'mydb', batch_size = INFLUX_BATCH_SIZE,
+                 flush_interval = INFLUX_FLUSH_INTERVAL, max_backoff = INFLUX_MAX_BACKOFF, clock = WALL_CLOCK):
+        super().__init__(name='influx-writer', daemon=True)
+        self.url = url
+        self.clock = clock
+        self.spool_path = spool_path
+        self.bucket = bucket
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.written = 0
+        self.spooled = 0
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+        self._write_api = None
+        self._backoff = 1.0
+        self._retry_at = 0.0
+
+    def write(self, bucket, org, record):
+        """Queues a point (dict or line protocol string) for writing. Never blocks."""
+        self._queue.put(record)
+
+    def close(self):
+        self._stopping.set()
+        self.join()
+        if os.path.exists(self.spool_path) and os.path.getsize(self.spool_path):
+            logging.warning(f"Database points not written yet are spooled in {self.spool_path}")
+
+    def run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._collect()
+            if batch or self._has_spool():
+                self._deliver(batch)
+
+    def _collect(self) -> list:
+        lines = []
+        deadline = self.clock.monotonic() + self.flush_interval
+        while len(lines) < self.batch_size:
+            timeout = deadline - self.clock.monotonic()
+            if timeout <= 0 or (self._stopping.is_set() and self._queue.empty()):
+                break
+            try:
+                record = self._queue.get(timeout=timeout / self.clock.speed)
+            except queue.Empty:
+                break
+            try:
+                lines.append(record if isinstance(record, str) else Point.from_dict(record, write_precision=WritePrecision.NS).to_line_protocol())
+            except Exception as e:
+                logging.error(f"Dropping malformed database point {record!r}: {e}")
+        return lines
+
+    def _has_spool(self) -> bool:
+        return self.spooled > 0
+
+    def _deliver(self, lines : list):
+        if self.url is None:
+            self._spool(lines)
+            return
+        if self.clock.monotonic() < self._retry_at and not self._stopping.is_set():
+            self._spool(lines)
+            return
+        try:
+            if self._write_api is None:
+                self._write_api = connect_db(self.url)
+                if not self._write_api:
+                    self._write_api = None
+                    raise ConnectionError(f"cannot reach {self.url}")
+            if self._has_spool():
+                self._replay()
+            if lines:
+                self._write_api.write(self.bucket, '', lines)
+                self.written += len(lines)
+            self._backoff = 1.0
+        except Exception as e:
+            logging.error(f"Error writing to db, spooling to {self.spool_path}: {e}")
+            self._write_api = None
+            self._spool(lines)
+            self._retry_at = self.clock.monotonic() + self._backoff
+            self._backoff = min(2 * self._backoff, self.max_backoff)
+
+    def _spool(self, lines : list):
+        if not lines:
+            return
+        with open(self.spool_path, 'a') as spool:
+            spool.write('\n'.join(lines) + '\n')
+        self.spooled += len(lines)
+
+    def _replay(self):
+        with open(self.spool_path) as spool:
+            lines = spool.read().splitlines()
+        for i in range(0, len(lines), self.batch_size):
+            self._write_api.write(self.bucket, '', lines[i:i + self.batch_size])
+        self.written += len(lines)
+        logging.warning(f"Replayed {len(lines)} spooled points to the database")
+        open(self.spool_path, 'w').close()
+        self.spooled = 0
+
+def connect_to_db(endpoint, spool_path, clock = WALL_CLOCK):
+    """Starts the background InfluxWriter for the endpoint. The run goes ahead whether or not
+    the database is reachable: points are spooled to spool_path until it is.
+    With endpoint None (simulated runs) the points are only ever spooled.
+    """
+    writer = InfluxWriter(endpoint, spool_path, clock=clock)
+    writer.start()
+    if endpoint is None:
+        print(f'\nLogging locally, database points go to {spool_path} only\n')
+        return writer
+    print(f'\nLogging locally, and to influxDB at {endpoint} in the background (spooling to {spool_path} while it is down)\n')
+    return writer
 
 def write_to_db(write_api, dictionary):
     try:
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Cycle-level benchmark of tacc.py against the simulated test box (tacc_sim.py).
+
+Runs complete thermal cycle profiles through tacc.run_test_box() and writes the wall time of
+every phase, the time to each setpoint, the overshoot, the instrument transactions per cycle
+and the interlock checks per minute to a JSON file, so that changes to ramp_up()/ramp_down()
+can be compared for regressions in cycle duration:
+
+    python tacc_bench.py -o before.json
+    python tacc_bench.py -o after.json -b before.json
+
+Times are run clock times, i.e. how long the cycle would take on the box.
+"""
+
+import json, os, subprocess, time, datetime
+import numpy as np
+import click
+
+import tacc, tacc_sim
+
+# n_cycles, min_temp, max_temp of the two standard cycles in the README
+PROFILES = {
+    'standard': (10, -45, 40),
+    'big': (1, -55, 60),
+}
+BENCH_SPEED = 100.0     # run clock speed up; much higher and Python overhead misses the watchdog deadlines
+BENCH_SEED = 1          # seed of the simulated noise, so runs are comparable
+
+class CallCounter:
+    """Counts the calls to a function of tacc for the duration of a with block."""
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+
+    def __enter__(self):
+        self._original = getattr(tacc, self.name)
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return self._original(*args, **kwargs)
+        setattr(tacc, self.name, counted)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        setattr(tacc, self.name, self._original)
+        return False
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def count_difference(end : dict, start : dict) -> dict:
+    """Transactions per instrument between two transaction totals."""
+    return {name: n - start.get(name, 0) for name, n in end.items() if n - start.get(name, 0)}
+
+def phase_metrics(phase, next_phase, columns, modules, end) -> dict:
+    """Duration, time to setpoint and overshoot of one phase from the run log.
+    The overshoot is the furthest any module NTC went past the target, up to the end of the
+    following phase, which is where a ramp that overshoots turns round.
+    """
+    t = columns['time'] / 1e9
+    ntc = columns['NTC']
+    ntcs = np.column_stack([columns[f'NTC {m}'] for m in modules])
+    phase_end = phase.end if phase.end is not None else end
+    window_end = next_phase.end if next_phase is not None and next_phase.end is not None else phase_end
+    in_phase = (t >= phase.start) & (t <= phase_end)
+    in_window = (t >= phase.start) & (t <= window_end)
+    reached = np.flatnonzero(in_window & (np.abs(ntc - phase.target) <= tacc.RAMP_TOLERANCE))
+    overshoot = None
+    if in_window.any() and in_phase.any():
+        down = ntc[in_phase][0] > phase.target
+        beyond = phase.target - ntcs[in_window].min() if down else ntcs[in_window].max() - phase.target
+        overshoot = round(max(float(beyond), 0.0), 2)
+    return {
+        'cycle': phase.cycle,
+        'phase': phase.phase,
+        'target': phase.target,
+        'duration': round(phase_end - phase.start, 1),
+        'time_to_setpoint': round(float(t[reached[0]] - phase.start), 1) if len(reached) else None,
+        'overshoot': overshoot,
+    }
+
+def run_profile(name, modules, speed = BENCH_SPEED, seed = BENCH_SEED, log_dir = '.', bus_profile = False) -> dict:
+    """Runs one profile of PROFILES on a fresh simulated box and measures it.
+    With bus_profile, the tacc.BusProfiler histograms of the run are included.
+    """
+    n_cycles, min_temp, max_temp = PROFILES[name]
+    tacc.please_kill.clear()
+    tacc.please_abort.clear()
+    tacc.tickers.clear()
+    backend = tacc_sim.SimBackend(tacc.RESOURCES, speed=speed, seed=seed)
+    state = tacc.CycleState()
+    state.counters = backend.transaction_totals
+    wall = time.monotonic()
+    start = backend.clock.time()
+    with CallCounter('interlock_test') as checks:
+        interlock_condition, cause, path = tacc.run_test_box(modules, n_cycles, min_temp, max_temp, backend=backend,
+                                                             endpoint=None, log_dir=log_dir, state=state, profile=bus_profile)
+    end = backend.clock.time()
+    end_counts = backend.transaction_totals()
+    columns = tacc.load_runlog(path)
+    minutes = (end - start) / 60
+
+    phases = []
+    for i, phase in enumerate(state.phases):
+        next_phase = state.phases[i + 1] if i + 1 < len(state.phases) else None
+        metrics = phase_metrics(phase, next_phase, columns, modules, end)
+        metrics['transactions'] = count_difference(phase.end_counts or end_counts, phase.start_counts)
+        phases.append(metrics)
+    cycles = []
+    for cycle in sorted({p.cycle for p in state.phases}):
+        records = [p for p in state.phases if p.cycle == cycle]
+        cycle_start, cycle_end = records[0].start, records[-1].end if records[-1].end is not None else end
+        cycles.append({
+            'cycle': cycle,
+            'duration': round(cycle_end - cycle_start, 1),
+            'transactions': count_difference(records[-1].end_counts or end_counts, records[0].start_counts),
+        })
+    result = {
+        'n_cycles': n_cycles,
+        'min_temp': min_temp,
+        'max_temp': max_temp,
+        'modules': list(modules),
+        'completed': not interlock_condition,
+        'cause': cause,
+        'duration': round(end - start, 1),
+        'real_time': round(time.monotonic() - wall, 1),
+        'run_log': path,
+        'phases': phases,
+        'cycles': cycles,
+        'transactions_per_cycle': round(np.mean([sum(c['transactions'].values()) for c in cycles]), 1) if cycles else None,
+        'interlock_checks_per_minute': {
+            'watchdog': round(state.watchdog_checks / minutes, 2),
+            'ramps': round(checks.calls / minutes, 2),
+        },
+        'ticks': {name: {'period': t.period, 'ticks': t.ticks, 'overruns': t.overruns, 'skipped': t.skipped, 'worst': round(t.worst, 3)}
+                  for name, t in tacc.tickers.items()},
+    }
+    if bus_profile:
+        result['bus_profile'] = tacc.bus_profiler.as_dict()
+    return result
+
+def phase_durations(profile : dict) -> dict:
+    """Mean duration of each kind of phase in a profile result."""
+    durations = {}
+    for p in profile['phases']:
+        durations.setdefault(p['phase'], []).append(p['duration'])
+    return {phase: float(np.mean(d)) for phase, d in durations.items()}
+
+def compare(results : dict, baseline : dict):
+    """Prints the change in duration of every profile and kind of phase against a baseline."""
+    change = lambda new, old: f"{old / 60:8.1f} -> {new / 60:8.1f} min ({100 * (new - old) / old:+.1f}%)" if old else f"{new / 60:8.1f} min"
+    for name, profile in results['profiles'].items():
+        old = baseline.get('profiles', {}).get(name)
+        if old is None:
+            continue
+        click.echo(f"{name}: {change(profile['duration'], old['duration'])}")
+        old_phases = phase_durations(old)
+        for phase, duration in phase_durations(profile).items():
+            if phase in old_phases:
+                click.echo(f"  {phase:16s} {change(duration, old_phases[phase])}")
+
+@click.command()
+@click.argument(
+    'modules',
+    type=int,
+    nargs=-1,
+)
+@click.option(
+    '-p',
+    '--profile',
+    'profiles',
+    type=click.Choice(list(PROFILES)),
+    multiple=True,
+    help='Profile to run (repeatable)  [default: all]'
+)
+@click.option(
+    '-s',
+    '--speed',
+    metavar='<factor>',
+    type=float,
+    default=BENCH_SPEED,
+    show_default=True,
+    help='How many times faster than real time the simulation runs'
+)
+@click.option(
+    '--seed',
+    metavar='<seed>',
+    type=int,
+    default=BENCH_SEED,
+    show_default=True,
+    help='Seed of the simulated noise'
+)
+@click.option(
+    '-o',
+    '--output',
+    metavar='<json>',
+    type=click.Path(dir_okay=False),
+    default='tacc_bench.json',
+    show_default=True,
+    help='File to write the results to'
+)
+@click.option(
+    '-b',
+    '--baseline',
+    metavar='<json>',
+    type=click.Path(exists=True, dir_okay=False),
+    help='Earlier results to compare the durations against'
+)
+@click.option(
+    '--bus-profile',
+    is_flag=True,
+    help='Include the per-instrument bus profile of every run (see tacc.py --profile)'
+)
+@click.option(
+    '--log-dir',
+    metavar='<dir>',
+    type=click.Path(file_okay=False),
+    default='bench_logs',
+    show_default=True,
+    help='Directory for the run logs of the benchmark runs'
+)
+@click.option(
+    '-v', '--verbosity',
+    count=True,
+    default=0,
+    help='Increase output verbosity: -v, -vv, -vvv'
+)
+def cli(modules, profiles, speed, seed, output, baseline, bus_profile, log_dir, verbosity):
+    """
+    Benchmarks complete thermal cycles against the simulated test box.
+
+    Examples: \n
+    python tacc_bench.py \n # Runs the standard (10x -45/40) and big (1x -55/60) profiles on all modules \n
+    python tacc_bench.py -p big -o after.json -b before.json \n # Runs the big profile and compares it with before.json
+    """
+    modules = list(modules) or [1, 2, 3, 4]
+    tacc.setup_logging(verbosity)
+    os.makedirs(log_dir, exist_ok=True)
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'speed': speed,
+        'seed': seed,
+        'settings': {name: getattr(tacc, name) for name in ['CONTROL_PERIOD', 'RAMP_DOWN_RATE', 'TRACKING_ERROR', 'RAMP_TOLERANCE',
+                                                            'WATCHDOG_PERIOD', 'TELEMETRY_PERIOD', 'COMMAND_GAPS']},
+        'profiles': {},
+    }
+    for name in profiles or PROFILES:
+        click.echo(f"Running {name}: {PROFILES[name][0]} x {PROFILES[name][1]}/{PROFILES[name][2]}°C at {speed:g}x")
+        result = run_profile(name, modules, speed, seed, log_dir, bus_profile)
+        results['profiles'][name] = result
+        click.echo(f"{name}: {result['duration'] / 60:.1f} min ({result['real_time']:.0f}s real), "
+                   f"{result['transactions_per_cycle']} transactions per cycle, "
+                   f"{'completed' if result['completed'] else 'stopped: ' + result['cause']}")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    click.echo(f"Written {output}")
+    if baseline:
+        with open(baseline) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    cli()
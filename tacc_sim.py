@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+"""Simulated test box for tacc.py.
+
+Stands in for the icicle instruments that tacc.open_channels() creates (ITkDCSInterlock,
+both HMP4040s, Keithley2410, HuberCC508 and the PIDControllers served by tricicle), all
+backed by one lumped thermal model of the box, so a full thermal cycle can be run with
+no hardware: python tacc.py --simulate --sim-speed 60
+"""
+
+import math, random, threading, time, os, collections
+from dataclasses import dataclass
+
+try:
+    import tomllib
+except ImportError:     # Python < 3.11: the PID controllers use DEFAULT_PID
+    tomllib = None
+
+AMBIENT = 21.0                  # °C, lab and box air temperature
+SENSOR_NOISE = 0.05             # standard deviation of temperature (°C) and humidity (%RH) readings
+BUS_LATENCY = 0.02              # seconds per instrument transaction, jittered by ±50%
+STEP = 0.5                      # seconds per integration step of the thermal model
+CHILLER_CAPACITY = 20000.0      # J/K, bath and cold plate
+CHILLER_TAU = 120.0             # seconds, time constant of the chiller's own temperature control
+CHILLER_HEAT_POWER = 1500.0     # W, maximum heating power of the chiller
+CHILLER_COOL_POWER = 1000.0     # W, maximum cooling power of the chiller at AMBIENT
+CHILLER_MIN_TEMP = -70.0        # °C at which the chiller's cooling power has fallen to zero
+CHILLER_LEAK = 2.0              # W/K, bath to lab
+CHUCK_CAPACITY = 400.0          # J/K, chuck
+MODULE_CAPACITY = 40.0          # J/K, module
+CHUCK_MODULE_CONDUCTANCE = 1.5  # W/K, chuck to module (poor without vacuum)
+CHUCK_AIR_CONDUCTANCE = 0.05    # W/K, chuck to box air
+PELT_SEEBECK = 0.05             # V/K
+PELT_RESISTANCE = 1.5           # Ω
+PELT_CONDUCTANCE = 0.8          # W/K, through the peltier, cold plate to chuck
+PELT_VOLTAGE_LIMIT = 12.0       # V, compliance of the peltier PSU channels
+LV_LOAD = 2.0                   # Ω, module low voltage load
+HV_LEAKAGE = 1e-8               # A/V, sensor leakage current
+SHT85_TAU = 300.0               # seconds, SHT85 (peltier back) following the cold plate
+SHT85_COUPLING = 0.2            # fraction of the way from the cold plate to AMBIENT the SHT85 settles at
+DRY_DEWPOINT = -65.0            # °C, dewpoint of the dry air flushing the box
+BOX_DEWPOINT = -20.0            # °C, dewpoint of the box at the start of a run
+PURGE_TAU = 900.0               # seconds, time constant of the dry air flush
+DEWPOINT_DRIFT = 0.05           # °C/sqrt(s), random walk of the box dewpoint
+RELAY_TRIP = 80.0               # °C of NTC at which the hardware interlock relay trips
+LID_CLOSED = 5.0                # V read on the lid switch when it is closed
+DEFAULT_PID = {'Kp': -1.5, 'Ki': -0.085, 'Kd': -0.01, 'sample_time': 0.5, 'starting_output': 0.0,
+               'output_limits': [0.0, 4.0], 'measure_type': 'NTC:TEMP'}
+
+class SimClock:
+    """Run clock of a simulation, running speed times faster than the wall clock. Has the
+    interface of tacc.WallClock: time(), monotonic(), perf_counter(), sleep() and wait(),
+    and is handed to tacc as instruments.clock through SimBackend.clock.
+    """
+    def __init__(self, speed = 1.0):
+        self.speed = float(speed)
+        self._wall0 = time.monotonic()
+        self._epoch0 = time.time()
+
+    def elapsed(self) -> float:
+        return (time.monotonic() - self._wall0) * self.speed
+
+    def time(self) -> float:
+        return self._epoch0 + self.elapsed()
+
+    def time_ns(self) -> int:
+        return int(self.time() * 1e9)
+
+    def monotonic(self) -> float:
+        return self._wall0 + self.elapsed()
+
+    perf_counter = monotonic
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0) / self.speed)
+
+    def wait(self, event, seconds) -> bool:
+        """Waits up to seconds of run clock time for event. Returns True if the event is set."""
+        return event.wait(max(seconds, 0) / self.speed)
+
+def magnus(temp) -> float:
+    return 17.625 * temp / (243.04 + temp)
+
+def relative_humidity(dewpoint, temp) -> float:
+    """Relative humidity in % of air at temp with the given dewpoint (inverse of tacc.dewpoint_array)."""
+    return 100 * math.exp(magnus(dewpoint) - magnus(temp))
+
+def load_pid_config(module, pid_config = None) -> dict:
+    """PID settings of the module, as tricicle would load them, falling back to DEFAULT_PID for
+    anything missing.
+    Args:
+        module: module number, filled in for {module} in pid_config
+        pid_config: config file path as in tacc.RESOURCES['pid_config'], relative to the working
+            directory like tricicle's; the pidcontroller_j<module>.toml next to this file if None
+    """
+    config = dict(DEFAULT_PID)
+    if pid_config is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"pidcontroller_j{module}.toml")
+    else:
+        path = pid_config.format(module=module)
+    if tomllib is not None and os.path.exists(path):
+        with open(path, 'rb') as f:
+            config.update(tomllib.load(f)['pidcontroller'][0])
+    return config
+
+@dataclass
+class PIDState:
+    """One tricicle PID loop: drives the current of its peltier PSU channel from its NTC or PT100."""
+    kp: float
+    ki: float
+    kd: float
+    sample_time: float
+    limits: tuple
+    measure_type: str
+    starting_output: float = 0.0
+    setpoint: float = 15.0
+    on: bool = False
+    integral: float = 0.0
+    last_input: float = None
+    elapsed: float = 0.0
+
+    @classmethod
+    def from_config(cls, config : dict):
+        return cls(kp=config['Kp'], ki=config['Ki'], kd=config['Kd'], sample_time=config['sample_time'],
+                   limits=tuple(config['output_limits']), measure_type=config['measure_type'],
+                   starting_output=config['starting_output'], setpoint=config.get('setpoint', 15.0))
+
+    def clamp(self, value) -> float:
+        return min(max(value, self.limits[0]), self.limits[1])
+
+    def update(self, measured, dt):
+        """Advances the loop by dt. Returns the output current, or None between samples."""
+        self.elapsed += dt
+        if self.elapsed < self.sample_time:
+            return None
+        dt, self.elapsed = self.elapsed, 0.0
+        if self.last_input is None:
+            self.last_input, self.integral = measured, self.clamp(self.starting_output)
+        error = self.setpoint - measured
+        self.integral = self.clamp(self.integral + self.ki * error * dt)
+        output = self.kp * error + self.integral - self.kd * (measured - self.last_input) / dt
+        self.last_input = measured
+        return self.clamp(output)
+
+    def reset(self):
+        self.integral, self.last_input, self.elapsed = 0.0, None, 0.0
+
+@dataclass
+class ModuleState:
+    """Chuck, module and supplies of one module slot."""
+    pid: PIDState
+    chuck: float = AMBIENT
+    ntc: float = AMBIENT
+    pelt_current: float = 0.0
+    pelt_voltage: float = PELT_VOLTAGE_LIMIT
+    pelt_on: bool = False
+    lv_voltage: float = 0.0
+    lv_current: float = 0.0
+    lv_on: bool = False
+
+    @property
+    def pelt_output(self) -> float:
+        """Current actually flowing through the peltier."""
+        return self.pelt_current if self.pelt_on else 0.0
+
+class ThermalModel:
+    """Lumped thermal model of the test box.
+
+    Chiller bath and cold plate (one node) -> peltier -> chuck (PT100) -> module (NTC), per
+    module slot, with heat leaks to the lab. The chiller runs its own proportional control
+    within power limits that shrink as it gets colder, and carries the heat the peltiers pump
+    into the cold plate. The PID loops of the tricicle controllers run inside the model.
+    The box humidity is modelled as its dewpoint, flushed towards DRY_DEWPOINT with a random
+    walk on top, and read by the SHT85 as relative humidity at its own temperature.
+
+    The state is integrated lazily in STEP increments of run clock time, whenever an
+    instrument reads or writes it. The PID loops are configured from pid_config, see load_pid_config().
+    """
+    def __init__(self, clock, noise = SENSOR_NOISE, seed = None, ambient = AMBIENT, dewpoint = BOX_DEWPOINT, pid_config = None):
+        self.clock = clock
+        self.noise = noise
+        self.ambient = ambient
+        self.rng = random.Random(seed)
+        self.lock = threading.RLock()
+        self.bath = ambient
+        self.chiller_setpoint = ambient
+        self.chiller_speed = 0
+        self.chiller_on = False
+        self.sht85 = ambient
+        self.dewpoint = dewpoint
+        self.modules = {ch: ModuleState(pid=PIDState.from_config(load_pid_config(ch, pid_config)), chuck=ambient, ntc=ambient) for ch in range(1, 5)}
+        self.hv_voltage = 0.0
+        self.hv_current = 1e-5
+        self.hv_on = False
+        self._last = clock.monotonic()
+
+    def advance(self):
+        """Integrates the model up to the current run clock time."""
+        with self.lock:
+            now = self.clock.monotonic()
+            while now - self._last >= STEP:
+                self._step(STEP)
+                self._last += STEP
+
+    def _step(self, dt):
+        load = 0.0
+        for m in self.modules.values():
+            if m.pid.on:
+                measured = m.chuck if m.pid.measure_type == 'PT100:TEMP' else m.ntc
+                output = m.pid.update(measured, dt)
+                if output is not None:
+                    m.pelt_current, m.pelt_on = output, True
+            i = m.pelt_output
+            cold = PELT_SEEBECK * i * (m.chuck + 273.15) - 0.5 * PELT_RESISTANCE * i**2 - PELT_CONDUCTANCE * (self.bath - m.chuck)
+            electrical = PELT_SEEBECK * i * (self.bath - m.chuck) + PELT_RESISTANCE * i**2
+            load += cold + electrical
+            module_power = m.lv_voltage * min(m.lv_current, m.lv_voltage / LV_LOAD) if m.lv_on else 0.0
+            to_module = CHUCK_MODULE_CONDUCTANCE * (m.chuck - m.ntc)
+            m.chuck += (-cold - to_module + CHUCK_AIR_CONDUCTANCE * (self.ambient - m.chuck)) / CHUCK_CAPACITY * dt
+            m.ntc += (to_module + module_power) / MODULE_CAPACITY * dt
+        power = 0.0
+        if self.chiller_on:
+            cool = CHILLER_COOL_POWER * max(self.bath - CHILLER_MIN_TEMP, 0) / (AMBIENT - CHILLER_MIN_TEMP)
+            power = (self.chiller_setpoint - self.bath) * CHILLER_CAPACITY / CHILLER_TAU - load
+            power = min(max(power, -cool), CHILLER_HEAT_POWER)
+        self.bath += (power + load + CHILLER_LEAK * (self.ambient - self.bath)) / CHILLER_CAPACITY * dt
+        self.sht85 += (self.bath + SHT85_COUPLING * (self.ambient - self.bath) - self.sht85) / SHT85_TAU * dt
+        self.dewpoint += (DRY_DEWPOINT - self.dewpoint) / PURGE_TAU * dt + self.rng.gauss(0, DEWPOINT_DRIFT * math.sqrt(dt))
+        self.dewpoint = min(self.dewpoint, self.sht85)
+
+    def noisy(self, value, sigma = None) -> float:
+        sigma = self.noise if sigma is None else sigma
+        return value + self.rng.gauss(0, sigma) if sigma > 0 else value
+
+class SimChannel:
+    """Base of the simulated channels: every attribute access is one transaction, which takes
+    the bus latency and brings the model up to date first.
+    """
+    def __init__(self, instrument, channel):
+        self.instrument = instrument
+        self.model = instrument.model
+        self.channel = channel
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def _get(self, fn):
+        self.instrument.transaction()
+        with self.model.lock:
+            return fn(self.model)
+
+    def _set(self, fn):
+        self.instrument.transaction()
+        with self.model.lock:
+            fn(self.model)
+
+class SimMeasure(SimChannel):
+    """A MeasureChannel: value reads the quantity of measure_type."""
+    def __init__(self, instrument, channel, measure_type):
+        super().__init__(instrument, channel)
+        self.measure_type = measure_type
+
+    @property
+    def value(self):
+        return self._get(lambda model: self._read(model))
+
+    def _read(self, model):
+        m = model.modules[self.channel]
+        readers = {
+            'NTC:TEMP': lambda: model.noisy(m.ntc),
+            'PT100:TEMP': lambda: model.noisy(m.chuck),
+            'RELAY:STATUS': lambda: 'TRIP' if m.ntc > RELAY_TRIP else 'OK',
+            'SHT85:TEMP': lambda: model.noisy(model.sht85),
+            'SHT85:HUMI': lambda: max(model.noisy(relative_humidity(model.dewpoint, model.sht85)), 0.01),
+            'LID:VOLT': lambda: model.noisy(LID_CLOSED, 0.01),
+        }
+        return readers[self.measure_type]()
+
+class SimReading:
+    """The measure_voltage / measure_current attribute of a PowerChannel."""
+    def __init__(self, channel, fn):
+        self._channel = channel
+        self._fn = fn
+
+    @property
+    def value(self):
+        return self._channel._get(self._fn)
+
+class SimPower(SimChannel):
+    """A PowerChannel of one of the HMP4040s: the peltier supply (driven by the PID loop of its
+    module) or the module low voltage supply.
+    """
+    def __init__(self, instrument, channel, prefix):
+        super().__init__(instrument, channel)
+        self.prefix = prefix
+        self.measure_voltage = SimReading(self, self._measured_voltage)
+        self.measure_current = SimReading(self, self._measured_current)
+
+    def _attr(self, model, name):
+        return getattr(model.modules[self.channel], f"{self.prefix}_{name}")
+
+    def _put(self, name, value):
+        self._set(lambda model: setattr(model.modules[self.channel], f"{self.prefix}_{name}", value))
+
+    @property
+    def voltage(self):
+        return self._get(lambda model: self._attr(model, 'voltage'))
+
+    @voltage.setter
+    def voltage(self, value):
+        self._put('voltage', float(value))
+
+    @property
+    def current(self):
+        return self._get(lambda model: self._attr(model, 'current'))
+
+    @current.setter
+    def current(self, value):
+        self._put('current', float(value))
+
+    @property
+    def state(self):
+        return self._get(lambda model: self._attr(model, 'on'))
+
+    @state.setter
+    def state(self, value):
+        self._put('on', bool(value))
+
+    @property
+    def status(self):
+        return self._get(lambda model: int(self._attr(model, 'on')))
+
+    def _measured_voltage(self, model):
+        m = model.modules[self.channel]
+        if self.prefix == 'pelt':
+            volts = PELT_SEEBECK * (model.bath - m.chuck) + PELT_RESISTANCE * m.pelt_output if m.pelt_on else 0.0
+            return model.noisy(min(volts, m.pelt_voltage), 0.001)
+        return model.noisy(min(m.lv_voltage, m.lv_current * LV_LOAD) if m.lv_on else 0.0, 0.001)
+
+    def _measured_current(self, model):
+        m = model.modules[self.channel]
+        if self.prefix == 'pelt':
+            return model.noisy(m.pelt_output, 0.001)
+        return model.noisy(min(m.lv_current, m.lv_voltage / LV_LOAD) if m.lv_on else 0.0, 0.001)
+
+class SimHV(SimChannel):
+    """The PowerChannel of the Keithley2410 sensor bias supply."""
+    def __init__(self, instrument, channel):
+        super().__init__(instrument, channel)
+        self.measure_voltage = SimReading(self, lambda model: model.hv_voltage if model.hv_on else 0.0)
+        self.measure_current = SimReading(self, lambda model: model.noisy(model.hv_voltage * HV_LEAKAGE, 1e-10) if model.hv_on else 0.0)
+
+    @property
+    def voltage(self):
+        return self._get(lambda model: model.hv_voltage)
+
+    @voltage.setter
+    def voltage(self, value):
+        self._set(lambda model: setattr(model, 'hv_voltage', float(value)))
+
+    @property
+    def current(self):
+        return self._get(lambda model: model.hv_current)
+
+    @current.setter
+    def current(self, value):
+        self._set(lambda model: setattr(model, 'hv_current', float(value)))
+
+    @property
+    def state(self):
+        return self._get(lambda model: model.hv_on)
+
+    @state.setter
+    def state(self, value):
+        self._set(lambda model: setattr(model, 'hv_on', bool(value)))
+
+    def sweep(self, target, step_size = 5, delay = 0.5):
+        steps = max(int(abs(target - self.voltage) / abs(step_size or 1)), 1)
+        for _ in range(steps):
+            self.instrument.backend.clock.sleep(delay)
+        self.voltage = target
+
+class SimChillerChannel(SimChannel):
+    """The TemperatureChannel of the HuberCC508: temperature reads the bath and sets the setpoint."""
+    @property
+    def temperature(self):
+        return self._get(lambda model: model.noisy(model.bath))
+
+    @temperature.setter
+    def temperature(self, value):
+        self._set(lambda model: setattr(model, 'chiller_setpoint', float(value)))
+
+    @property
+    def speed(self):
+        return self._get(lambda model: model.chiller_speed)
+
+    @speed.setter
+    def speed(self, value):
+        self._set(lambda model: setattr(model, 'chiller_speed', value))
+
+    @property
+    def state(self):
+        return self._get(lambda model: model.chiller_on)
+
+    @state.setter
+    def state(self, value):
+        self._set(lambda model: setattr(model, 'chiller_on', bool(value)))
+
+class SimPIDChannel(SimChannel):
+    """The TemperatureChannel of a tricicle PIDController: temperature is the setpoint, state
+    switches the loop. Switching it off zeroes the peltier current, as tricicle does.
+    """
+    @property
+    def pid(self) -> PIDState:
+        return self.model.modules[self.instrument.module].pid
+
+    @property
+    def temperature(self):
+        return self._get(lambda model: self.pid.setpoint)
+
+    @temperature.setter
+    def temperature(self, value):
+        self._set(lambda model: setattr(self.pid, 'setpoint', float(value)))
+
+    @property
+    def state(self):
+        return self._get(lambda model: self.pid.on)
+
+    @state.setter
+    def state(self, value):
+        self._set(lambda model: self._switch(model, bool(value)))
+
+    def _switch(self, model, on):
+        if on and not self.pid.on:
+            self.pid.reset()
+        self.pid.on = on
+        if not on:
+            model.modules[self.instrument.module].pelt_current = 0.0
+
+class SimInstrument:
+    """Base of the simulated instruments, with the channel() factory and the context manager
+    of an icicle Instrument.
+    """
+    channels = {}
+
+    def __init__(self, backend, resource):
+        self.backend = backend
+        self.model = backend.model
+        self.resource = resource
+        self.name = backend.name_of(resource)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def transaction(self):
+        """Takes the time of one transaction on the bus, then brings the model up to date."""
+        self.backend.count(self.name)
+        if self.backend.latency > 0:
+            self.backend.clock.sleep(self.backend.latency * self.model.rng.uniform(0.5, 1.5))
+        self.model.advance()
+
+    def channel(self, kind, channel, **kwargs):
+        if kind not in self.channels:
+            raise ValueError(f"{type(self).__name__} has no {kind}")
+        return self.channels[kind](self, channel, **kwargs)
+
+class SimInterlock(SimInstrument):
+    channels = {'MeasureChannel': SimMeasure}
+
+class SimHMP4040(SimInstrument):
+    def __init__(self, backend, resource, prefix):
+        super().__init__(backend, resource)
+        self.channels = {'PowerChannel': lambda instrument, channel: SimPower(instrument, channel, prefix)}
+
+class SimKeithley2410(SimInstrument):
+    channels = {'PowerChannel': SimHV}
+
+class SimHuberCC508(SimInstrument):
+    channels = {'TemperatureChannel': SimChillerChannel}
+
+class SimPIDController(SimInstrument):
+    channels = {'TemperatureChannel': SimPIDChannel}
+
+    def __init__(self, backend, resource, module):
+        super().__init__(backend, resource)
+        self.module = module
+
+class SimBackend:
+    """Drop-in for the icicle instrument classes and open_tricicles() in tacc.open_channels().
+    Which simulated instrument a resource gets is looked up in resources (tacc.RESOURCES), so
+    the two HMP4040s are told apart the same way as on the bench.
+    Args:
+        resources: dict of instrument name to resource, with 'pid_port0' for the PID controllers
+            and 'pid_config' for the settings of their loops
+        speed: run clock seconds per wall clock second
+        noise: standard deviation of the temperature and humidity readings
+        latency: run clock seconds per instrument transaction
+        seed: seed of the noise and humidity random walk, for repeatable runs
+    """
+    def __init__(self, resources, speed = 1.0, noise = SENSOR_NOISE, latency = BUS_LATENCY, seed = None):
+        self.resources = resources
+        self.clock = SimClock(speed)
+        self.model = ThermalModel(self.clock, noise, seed, pid_config=resources.get('pid_config'))
+        self.latency = latency
+        self.transactions = collections.Counter()   # instrument name -> transactions so far
+        self._names = {resource: name for name, resource in resources.items()}
+        self._count_lock = threading.Lock()
+
+    def name_of(self, resource) -> str:
+        """Instrument name of a resource in resources; 'pid' for the PID controllers."""
+        return self._names.get(resource, 'pid')
+
+    def count(self, name):
+        with self._count_lock:
+            self.transactions[name] += 1
+
+    def transaction_totals(self) -> dict:
+        """Transactions per instrument name so far. Differences of two totals give the
+        transactions in between, e.g. of a phase (see tacc.CycleState.counters).
+        """
+        with self._count_lock:
+            return dict(self.transactions)
+
+    def ITkDCSInterlock(self, resource):
+        return SimInterlock(self, resource)
+
+    def HMP4040(self, resource):
+        return SimHMP4040(self, resource, 'pelt' if self.name_of(resource) == 'pelt_psu' else 'lv')
+
+    def Keithley2410(self, resource):
+        return SimKeithley2410(self, resource)
+
+    def HuberCC508(self, resource):
+        return SimHuberCC508(self, resource)
+
+    def PIDController(self, resource):
+        port = int(resource.split('::')[2])
+        return SimPIDController(self, resource, port - self.resources['pid_port0'])
+
+    def open_tricicles(self, modules, port0, config = None):
+        """The PID loops run inside the model, so there are no processes to start."""
+        return {}
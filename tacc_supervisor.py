@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""Runs the thermal cycles of several test boxes from one supervisor.
+
+Each box of the resource map runs tacc.run_test_box() in its own worker process, so a fault in
+one box (an instrument that does not answer, an exception, a crash) stops only that box. The
+workers report their status and latest telemetry to the supervisor, which prints a status table
+and keeps all of it in one place: <log dir>/supervisor_status.json and supervisor_telemetry.jsonl.
+
+    python tacc_supervisor.py boxes.toml -n 10 -t -45 40
+"""
+
+import json, math, multiprocessing, os, queue, signal, threading, time, traceback, logging
+import click
+
+import tacc, tacc_sim
+
+try:
+    import tomllib
+except ImportError:     # Python < 3.11
+    tomllib = None
+
+STATUS_PERIOD = 10.0        # seconds between status reports of the workers, and status tables of the supervisor
+DEVICE_RESOURCES = ['interlock', 'lv_psu', 'pelt_psu', 'hv_psu', 'huber']
+FINAL_STATES = ['done', 'stopped', 'interlock', 'failed', 'crashed']
+
+def load_boxes(path, n_cycles, min_temp, max_temp) -> list:
+    """Reads the [[box]] tables of a resource map. Every box needs a name and all the keys of
+    tacc.RESOURCES, including its own pid_config, as the default config files drive the
+    peltiers of one particular box; modules, n_cycles, min_temp and max_temp are optional.
+    Returns:
+        A list of dicts with name, modules, n_cycles, min_temp, max_temp and resources.
+    Raises:
+        click.ClickException if the map is incomplete, a PID config cannot be read, or two
+        boxes share a device or port.
+    """
+    if tomllib is None:
+        raise click.ClickException("Reading the resource map needs Python 3.11 or later (tomllib)")
+    with open(path, 'rb') as f:
+        tables = tomllib.load(f).get('box', [])
+    if not tables:
+        raise click.ClickException(f"No [[box]] tables in {path}")
+    boxes = []
+    for n, table in enumerate(tables, 1):
+        name = table.get('name', f'box{n}')
+        missing = [key for key in tacc.RESOURCES if key not in table]
+        if missing:
+            raise click.ClickException(f"Box {name!r} has no {', '.join(missing)}")
+        resources = {key: table[key] for key in tacc.RESOURCES}
+        modules = list(table.get('modules', [1, 2, 3, 4]))
+        if len(modules) > 1 and '{module}' not in resources['pid_config']:
+            raise click.ClickException(f"Box {name!r}: pid_config needs {{module}}, one config file per module")
+        boxes.append({
+            'name': name,
+            'modules': modules,
+            'n_cycles': table.get('n_cycles', n_cycles),
+            'min_temp': table.get('min_temp', min_temp),
+            'max_temp': table.get('max_temp', max_temp),
+            'resources': resources,
+        })
+    check_clashes(boxes)
+    return boxes
+
+def device_of(resource) -> str:
+    """The serial port or socket of a VISA resource, so that spellings of the same device compare
+    equal: 'ASRL/dev/ttyACM0::INSTR' and '/dev/ttyACM0' are '/dev/ttyACM0', and
+    'TCPIP::127.0.0.1::9898::SOCKET' is 'localhost:9898'.
+    """
+    parts = str(resource).split('::')
+    if parts[0].startswith('ASRL'):
+        return parts[0][len('ASRL'):]
+    if parts[0].startswith('TCPIP') and len(parts) > 2:
+        host = 'localhost' if parts[1] in ('localhost', '127.0.0.1') else parts[1]
+        return f"{host}:{parts[2]}"
+    return parts[0]
+
+def pid_devices(box) -> set:
+    """Devices the PID controllers of a box drive and read, from the power_resource and
+    measure_resource of its pid_config files.
+    """
+    devices = set()
+    for m in box['modules']:
+        path = box['resources']['pid_config'].format(module=m)
+        try:
+            with open(path, 'rb') as f:
+                controllers = tomllib.load(f).get('pidcontroller', [])
+        except (OSError, tomllib.TOMLDecodeError) as e:
+            raise click.ClickException(f"Box {box['name']!r}: cannot read the PID config {path}: {e}")
+        for controller in controllers:
+            devices.update(device_of(controller[key]) for key in ('power_resource', 'measure_resource') if key in controller)
+    return devices
+
+def box_devices(box) -> set:
+    """Every device of a box: its instruments, the devices of its PID configs, and the local
+    ports of its PID controllers.
+    """
+    resources = box['resources']
+    devices = {device_of(resources[key]) for key in DEVICE_RESOURCES}
+    devices |= pid_devices(box)
+    devices |= {f"localhost:{resources['pid_port0'] + m}" for m in box['modules']}
+    return devices
+
+def check_clashes(boxes : list):
+    """Raises click.ClickException naming every device, port or box name used by more than one box."""
+    clashes = []
+    owners = {}
+    for box in boxes:
+        used = [('name', box['name'])]
+        used += [('device', device) for device in box_devices(box)]
+        for kind, value in set(used):
+            if (kind, value) in owners:
+                clashes.append(f"{kind} {value} in {owners[kind, value]} and {box['name']}")
+            owners.setdefault((kind, value), box['name'])
+    if clashes:
+        raise click.ClickException("Boxes clash: " + '; '.join(clashes))
+
+def plain(value):
+    """JSON-friendly copy of a telemetry value: NaN becomes None, arrays become lists."""
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    if isinstance(value, list):
+        return [plain(v) for v in value]
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+class StatusReporter(threading.Thread):
+    """Sends the progress and latest telemetry row of a box's run to the supervisor every period."""
+    def __init__(self, box, state, messages, period = STATUS_PERIOD):
+        super().__init__(name='status-reporter', daemon=True)
+        self.box = box
+        self.state = state
+        self.messages = messages
+        self.period = period
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+    def run(self):
+        while not self._stopping.wait(self.period):
+            self.messages.put(self.status())
+
+    def status(self) -> dict:
+        status = {'box': self.box['name'], 'state': 'running', 'pid': os.getpid(), 'time': time.time(),
+                  'cycle': self.state.cycle, 'n_cycles': self.box['n_cycles'], 'phase': self.state.phase}
+        telemetry = self.state.telemetry
+        rows = telemetry.window(1) if telemetry is not None else []
+        if len(rows):
+            row = rows[0]
+            status['telemetry'] = {'time': int(row['time']) / 1e9,
+                                   **{name: plain(row[name]) for name in ('ntc', 'pt100', 'humi', 'temp_85', 'dewpoint', 'chiller')}}
+        return status
+
+def stop_handler(sig, frame):
+    # SIGTERM from the supervisor: the first finishes the current cycle, the second stops now
+    if tacc.please_kill.is_set():
+        tacc.please_abort.set()
+    else:
+        tacc.please_kill.set()
+
+def box_worker(box, settings, messages):
+    """Runs the thermal cycle of one box in its own process, reporting to the supervisor through messages."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # Ctrl+C is for the supervisor, which forwards it as SIGTERM
+    signal.signal(signal.SIGTERM, stop_handler)
+    log_dir = os.path.join(settings['log_dir'], box['name'])
+    os.makedirs(log_dir, exist_ok=True)
+    levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(filename=os.path.join(log_dir, 'tacc.log'), level=levels[min(settings['verbosity'], len(levels) - 1)],
+                        format='[%(asctime)s][%(name)s][%(levelname)s] - %(message)s')
+    tacc.BOX_NAME = box['name']
+    backend = None
+    if settings['simulate']:
+        backend = tacc_sim.SimBackend(box['resources'], speed=settings['sim_speed'])
+    state = tacc.CycleState()
+    reporter = StatusReporter(box, state, messages, settings['status_period'])
+    reporter.start()
+    result = {'box': box['name'], 'pid': os.getpid()}
+    try:
+        interlock_condition, cause, path = tacc.run_test_box(
+            box['modules'], box['n_cycles'], box['min_temp'], box['max_temp'], box['resources'], backend,
+            watchdog_period=settings['watchdog_period'], log_period=settings['log_period'],
+            endpoint=None if settings['simulate'] else tacc.ENDPOINT, log_dir=log_dir, state=state)
+        if interlock_condition:
+            result.update(state='interlock', cause=cause)
+        else:
+            result.update(state='stopped' if tacc.please_kill.is_set() else 'done')
+        result['run_log'] = path
+    except BaseException as e:
+        logging.critical(f"Box {box['name']} failed: {e}\n{traceback.format_exc()}")
+        result.update(state='failed', cause=f"{type(e).__name__}: {e}")
+    finally:
+        reporter.stop()
+    result.update(time=time.time(), cycle=state.cycle, n_cycles=box['n_cycles'], phase=state.phase)
+    messages.put(result)
+
+class Supervisor:
+    """Starts a worker process per box and collects their reports.
+    The latest report of every box is in status, and every report is appended to
+    <log dir>/supervisor_telemetry.jsonl as it arrives.
+    """
+    def __init__(self, boxes, settings):
+        self.boxes = boxes
+        self.settings = settings
+        self.status = {box['name']: {'box': box['name'], 'state': 'starting', 'cycle': 0, 'n_cycles': box['n_cycles'], 'phase': 'idle'}
+                       for box in boxes}
+        self.processes = {}
+        self.stops = 0
+        context = multiprocessing.get_context('spawn')   # fresh interpreter per box: no shared tacc globals
+        self._context = context
+        self._messages = context.Queue()
+        self._log_dir = settings['log_dir']
+        self._stream = None
+
+    def start(self):
+        os.makedirs(self._log_dir, exist_ok=True)
+        self._stream = open(os.path.join(self._log_dir, 'supervisor_telemetry.jsonl'), 'a')
+        for box in self.boxes:
+            process = self._context.Process(target=box_worker, args=(box, self.settings, self._messages), name=f"tacc-{box['name']}")
+            process.start()
+            self.processes[box['name']] = process
+            click.echo(f"Started {box['name']} (pid {process.pid}): modules {box['modules']}, "
+                       f"{box['n_cycles']} x {box['min_temp']}/{box['max_temp']}°C")
+
+    def stop(self):
+        """Forwards a stop to every running box: the first after its current cycle, the second straight away."""
+        self.stops += 1
+        click.echo('Stopping all boxes ' + ('after the current cycle' if self.stops == 1 else 'now'))
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()     # SIGTERM, handled by stop_handler
+
+    def run(self) -> dict:
+        """Collects reports until every box has finished. Returns the final status of every box."""
+        next_table = time.monotonic()
+        while not all(s['state'] in FINAL_STATES for s in self.status.values()):
+            self._collect(timeout=1.0)
+            dead = [name for name, p in self.processes.items() if not p.is_alive() and self.status[name]['state'] not in FINAL_STATES]
+            if dead:
+                self._collect(timeout=0.5)   # a final report may still be in flight
+                for name in dead:
+                    if self.status[name]['state'] not in FINAL_STATES:
+                        self._update({'box': name, 'state': 'crashed', 'cause': f"exit code {self.processes[name].exitcode}", 'time': time.time()})
+            if time.monotonic() >= next_table:
+                self.print_table()
+                next_table += self.settings['status_period']
+        for process in self.processes.values():
+            process.join()
+        self.print_table()
+        self._stream.close()
+        return self.status
+
+    def _collect(self, timeout):
+        try:
+            message = self._messages.get(timeout=timeout)
+            while True:
+                self._update(message)
+                message = self._messages.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _update(self, message : dict):
+        name = message['box']
+        self.status[name] = {**self.status[name], **message}
+        self._stream.write(json.dumps(message) + '\n')
+        self._stream.flush()
+        if message['state'] in FINAL_STATES:
+            cause = f": {message['cause']}" if message.get('cause') else ''
+            click.echo(f"{name} {message['state']}{cause}")
+        path = os.path.join(self._log_dir, 'supervisor_status.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.status, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def print_table(self):
+        lines = [time.strftime('%H:%M:%S')]
+        for name, s in self.status.items():
+            line = f"  {name:12s} {s['state']:9s} cycle {s['cycle']}/{s['n_cycles']} {s['phase']:16s}"
+            telemetry = s.get('telemetry')
+            if telemetry:
+                ntc = [t for t in telemetry['ntc'] if t is not None]
+                margin = [t - telemetry['dewpoint'] for t in telemetry['pt100'] if t is not None] if telemetry['dewpoint'] is not None else []
+                line += f" NTC {sum(ntc) / len(ntc):6.1f}°C" if ntc else ''
+                line += f" margin {min(margin):5.1f}°C" if margin else ''
+                line += f" chiller {telemetry['chiller']:6.1f}°C" if telemetry['chiller'] is not None else ''
+            lines.append(line)
+        click.echo('\n'.join(lines))
+
+@click.command()
+@click.argument(
+    'resource_map',
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    '-n',
+    '--n-cycles',
+    metavar="<n cycles>",
+    type=int,
+    default=10,
+    show_default=True,
+    help='Number of temperature cycles to run, for boxes that do not set n_cycles'
+)
+@click.option(
+    '-t',
+    '--temp-range',
+    metavar='<min max>',
+    type=float,
+    nargs=2,
+    default=(-40, 45),
+    show_default=True,
+    help='Temperature range, for boxes that do not set min_temp and max_temp'
+)
+@click.option(
+    '-w',
+    '--watchdog-period',
+    metavar='<seconds>',
+    type=float,
+    default=tacc.WATCHDOG_PERIOD,
+    show_default=True,
+    help='Period of the interlock watchdog checks'
+)
+@click.option(
+    '-l',
+    '--log-period',
+    metavar='<seconds>',
+    type=float,
+    default=tacc.TELEMETRY_PERIOD,
+    show_default=True,
+    help='Period of the telemetry records'
+)
+@click.option(
+    '-s',
+    '--status-period',
+    metavar='<seconds>',
+    type=float,
+    default=STATUS_PERIOD,
+    show_default=True,
+    help='Period of the status reports and tables'
+)
+@click.option(
+    '--log-dir',
+    metavar='<dir>',
+    type=click.Path(file_okay=False),
+    default='.',
+    show_default=True,
+    help='Directory for the supervisor files, with a subdirectory of run logs per box'
+)
+@click.option(
+    '--simulate',
+    is_flag=True,
+    help='Run every box against its own simulated test box (tacc_sim.py)'
+)
+@click.option(
+    '--sim-speed',
+    metavar='<factor>',
+    type=float,
+    default=1.0,
+    show_default=True,
+    help='With --simulate: how many times faster than real time the simulations run'
+)
+@click.option(
+    '-v', '--verbosity',
+    count=True,
+    default=0,
+    help='Increase output verbosity of the box logs: -v, -vv, -vvv'
+)
+def cli(resource_map, n_cycles, temp_range, watchdog_period, log_period, status_period, log_dir, simulate, sim_speed, verbosity):
+    """
+    Runs the thermal cycles of several test boxes, one worker process per box.
+
+    RESOURCE_MAP is a TOML file with a [[box]] table per box, see the README.
+    Ctrl+C stops every box after its current cycle; a second Ctrl+C stops them straight away.
+    """
+    min_temp, max_temp = temp_range
+    boxes = load_boxes(resource_map, n_cycles, min_temp, max_temp)
+    settings = {
+        'log_dir': log_dir,
+        'watchdog_period': watchdog_period,
+        'log_period': log_period,
+        'status_period': status_period,
+        'simulate': simulate,
+        'sim_speed': sim_speed,
+        'verbosity': verbosity,
+    }
+    supervisor = Supervisor(boxes, settings)
+    signal.signal(signal.SIGINT, lambda sig, frame: supervisor.stop())
+    supervisor.start()
+    status = supervisor.run()
+    failed = [name for name, s in status.items() if s['state'] != 'done']
+    if failed:
+        raise click.ClickException('Not completed: ' + ', '.join(f"{name} ({status[name]['state']})" for name in failed))
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,12 @@
+"""tacc_bench.py runs at its default speed: the big profile on two modules, which used to trip
+the interlock watchdog on missed deadlines, has to complete.
+"""
+
+import tacc_bench
+
+def test_big_profile_completes(tmp_path):
+    result = tacc_bench.run_profile('big', [1, 2], log_dir=str(tmp_path))
+    assert result['completed'], result['cause']
+    assert [p['phase'] for p in result['phases']] == ['ramp down', 'ramp up', 'final ramp down']
+    total = sum(sum(p['transactions'].values()) for p in result['phases'])
+    assert total == sum(sum(c['transactions'].values()) for c in result['cycles'])
@@ -0,0 +1,99 @@
+"""InfluxWriter against a local stand-in for the InfluxDB HTTP API: spooling while the
+database is down, replay once it is back, and the reconnection backoff.
+"""
+
+import http.server, socket, threading, time
+import pytest
+
+import tacc
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    """Answers /ping and /api/v2/write like InfluxDB 2, keeping the written lines."""
+    lines = []
+
+    def do_GET(self):
+        self.send_response(204 if self.path.startswith('/ping') else 404)
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        if self.path.startswith('/api/v2/write'):
+            StandIn.lines.extend(body.splitlines())
+            self.send_response(204)
+        else:
+            self.send_response(404)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def database():
+    """URL of a stand-in database that is down until its start() is called."""
+    port = free_port()
+    StandIn.lines = []
+    servers = []
+    def start():
+        server = http.server.HTTPServer(('localhost', port), StandIn)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    yield f'http://localhost:{port}', start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def point(n) -> str:
+    return f'test,location=here value={n} {n}'
+
+def test_spools_while_down_and_replays_when_back(database, tmp_path):
+    url, start = database
+    spool = tmp_path / 'spool.lp'
+    writer = tacc.InfluxWriter(url, str(spool))
+    writer._deliver([point(1), point(2)])
+    assert writer.spooled == 2
+    assert spool.read_text().splitlines() == [point(1), point(2)]
+    assert StandIn.lines == []
+
+    start()
+    writer._retry_at = 0.0
+    writer._deliver([point(3)])
+    assert StandIn.lines == [point(1), point(2), point(3)]
+    assert writer.written == 3
+    assert writer.spooled == 0
+    assert spool.read_text() == ''
+
+def test_backoff_doubles_up_to_the_limit(database, tmp_path):
+    url, start = database
+    writer = tacc.InfluxWriter(url, str(tmp_path / 'spool.lp'), max_backoff=4.0)
+    backoffs = []
+    for n in range(4):
+        writer._retry_at = 0.0
+        writer._deliver([point(n)])
+        backoffs.append(writer._backoff)
+    assert backoffs == [2.0, 4.0, 4.0, 4.0]
+    assert writer._retry_at > time.monotonic()
+    # before the retry time the batch goes straight to the spool, without a connection attempt
+    writer._deliver([point(4)])
+    assert writer.spooled == 5
+
+    start()
+    writer._retry_at = 0.0
+    writer._deliver([])
+    assert len(StandIn.lines) == 5
+    assert writer._backoff == 1.0
+
+def test_background_thread_writes_queued_points(database, tmp_path):
+    url, start = database
+    start()
+    writer = tacc.InfluxWriter(url, str(tmp_path / 'spool.lp'), flush_interval=0.1)
+    writer.start()
+    for n in range(3):
+        writer.write('mydb', '', point(n))
+    writer.close()
+    assert StandIn.lines == [point(0), point(1), point(2)]
+    assert writer.spooled == 0